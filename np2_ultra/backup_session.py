@@ -3,6 +3,7 @@ from np2_ultra.scripts import transfer
 
 '''
 Backs up a session to backup drive.
+Only files that are missing or changed on the backup drive are copied, so it can be rerun on a partly backed up session.
 '''
 
 
@@ -11,7 +12,9 @@ if __name__ == "__main__":
     parser.add_argument('date', type=str)
     parser.add_argument('mouse_id', type=str)
     parser.add_argument('--destination', nargs="+", default=("backup_drive",''))
+    parser.add_argument('--n_threads', type=int, default=4)
+    parser.add_argument('--compress', action='store_true', help='store continuous.dat files losslessly compressed')
 
     args = parser.parse_args()
 
-    transfer.TransferFiles(args.date, args.mouse_id, args.destination).run_it()
+    transfer.TransferFiles(args.date, args.mouse_id, args.destination, n_threads=args.n_threads, incremental=True, compress=args.compress).run_it()
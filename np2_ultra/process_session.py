@@ -1,8 +1,10 @@
 import argparse
-from np2_ultra.scripts import transfer, kilosort, waveforms
+from np2_ultra.scripts import transfer, kilosort, waveforms, pipeline
 
 '''
 Runs transfer to data drive, kilosort, and waveform extraction on a session.
+By default the stages overlap: each recording/probe is sorted as soon as it's transferred and extracted as soon as it's sorted
+(see pipeline.SessionPipeline). --sequential runs each stage on the whole session before starting the next.
 Can specify recordings/probes but no other custom parameters.
 '''
 
@@ -12,12 +14,31 @@ if __name__ == "__main__":
     #for all scripts
     parser.add_argument('date', type=str)
     parser.add_argument('mouse_id', type=str)
+    parser.add_argument('--backup', action='store_true', help='also copy the session to the backup drive, reading the rig files only once')
+    parser.add_argument('--compress', action='store_true', help='store continuous.dat files losslessly compressed')
     #for kilosort and waveforms
     parser.add_argument('--probes_to_run', nargs="+", default='all')
     parser.add_argument('--recordings_to_run', nargs="+", default='all')
+    #for waveforms
+    parser.add_argument('--n_workers', type=int, default=1)
+    parser.add_argument('--n_probe_jobs', type=int, default=1)
+    #for the pipelined run
+    parser.add_argument('--sequential', action='store_true', help='run transfer, then kilosort, then waveforms on the whole session')
+    parser.add_argument('--kilosort_jobs', type=int, default=1)
 
     args = parser.parse_args()
 
-    transfer.TransferFiles(args.date, args.mouse_id).run_it()
-    kilosort.RunKilosort(args.date, args.mouse_id, args.probes_to_run, args.recordings_to_run)
-    waveforms.GetWaveforms(args.date, args.mouse_id, args.probes_to_run, args.recordings_to_run).run_it()
+    if args.backup==True:
+        destinations = [('dest_root', 'np2_data'), ('backup_drive', '')]
+    else:
+        destinations = ('dest_root', 'np2_data')
+    if args.sequential==True:
+        transfer.TransferFiles(args.date, args.mouse_id, destinations, compress=args.compress).run_it()
+        kilosort.RunKilosort(args.date, args.mouse_id, args.probes_to_run, args.recordings_to_run)
+        waveforms.GetWaveforms(args.date, args.mouse_id, args.probes_to_run, args.recordings_to_run, n_workers=args.n_workers, n_probe_jobs=args.n_probe_jobs).run_it()
+    else:
+        pipeline.SessionPipeline(args.date, args.mouse_id, args.probes_to_run, args.recordings_to_run,
+                                kilosort_jobs=args.kilosort_jobs,
+                                waveform_jobs=args.n_probe_jobs,
+                                transfer_kwargs={'destination': destinations, 'compress': args.compress},
+                                waveform_kwargs={'n_workers': args.n_workers}).run_it()
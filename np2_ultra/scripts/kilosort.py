@@ -2,69 +2,134 @@ import os
 import glob2
 from datetime import datetime
 import time
-import shutil
 import json
-import matlab.engine
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
-from np2_ultra.tools import io, file_tools
+from np2_ultra.tools import io, file_tools, matlab_tools, kilosort_tools, validation_tools
+import np2_ultra.tools.compress_tools as ct
 import np2_ultra.files as files
 
+KS_SCRIPT_NAME = 'kilosort_probe.m'
+QUEUE_NAME = 'kilosort_queue.sqlite'
+
 class RunKilosort():
-    def __init__(self, date, mouse_id, probes_to_run='all', recordings_to_run='all'):
+    def __init__(self, date, mouse_id, probes_to_run='all', recordings_to_run='all', run_now=True, n_engines=1, engine_pool=None, queue=None, max_attempts=2, priority=0, validate=True):
         '''
         date: string, 'YYYY-MM-DD' or 'today' to run with today's date
         mouse_id: string,
         probes_to_run: if not 'all' then must be a list of capital letters eg ['A']
         recordings_to_run: if not 'all' then must be a list of strings in format 'recordingN' eg ['recording1']
+        run_now: if True sorts every recording/probe right away. If False only sets up, for running probes one at a time with run_probe
+            while the session is still being transferred (see pipeline.SessionPipeline)
+        n_engines: number of MATLAB engines kept running, ie how many probes are sorted at once. Engines are shared by every
+            RunKilosort in the process with the same n_engines, so later sessions don't wait for MATLAB to start
+        engine_pool: matlab_tools.EnginePool to use instead of the shared one
+        queue: kilosort_tools.KilosortQueue to record jobs in. default None uses kilosort_queue.sqlite on this computer's disk
+            (see io.get_local_state_file), the queue isn't kept on dest_root because SQLite locking isn't reliable on network shares
+        max_attempts: number of times a recording/probe is tried before it's flagged as failed
+        priority: queue priority of this session's jobs, higher runs first when the queue is drained
+        validate: if True checks each continuous.dat with validation_tools.validate_dat before sorting it, and flags probes that fail
         '''
         self.date = date
         self.mouse_id = mouse_id
         self.probes = probes_to_run
         self.recordings = recordings_to_run
+        self.n_engines = n_engines
+        self.engine_pool = engine_pool
+        self.max_attempts = max_attempts
+        self.priority = priority
+        self.validate = validate
         self.computer_names = io.read_computer_names()
+        if queue is None:
+            queue = kilosort_tools.KilosortQueue(io.get_local_state_file(QUEUE_NAME, self.computer_names), max_attempts)
+        self.queue = queue
         self.pxi_dict = io.read_pxi_dict()
+        self.dirs_lock = threading.Lock()
 
-        self.get_all_file_locations()
-        self.run_kilosort()
+        if run_now==True:
+            self.get_all_file_locations()
+            self.run_kilosort()
+        else:
+            self.get_all_file_locations(find_probes=False)
 
-    def get_all_file_locations(self):
+    def get_all_file_locations(self, find_probes=True):
         self.get_files = file_tools.GetFiles(self.date, self.mouse_id)
         self.main_folder = self.get_files.session_dir
+        self.session = self.get_files.s_id
         self.bad_dats_txt = os.path.join(self.main_folder, "bad_dat_files.txt")
-        self.get_files.get_probe_dirs(probes='all')
-        self.probe_dict = self.get_files.probe_data_dirs
-        self.path_to_ks_one_oh, self.path_to_ks_ultra = io.get_paths_to_kilosort_templates()
-
-    def write_ks_file(self, probe_dir):
-        if '.0' in probe_dir:
-            session_file = os.path.join(self.main_folder, "kilosort_one_oh_session.m")
-            if os.path.exists(session_file)==False:
-                shutil.copy(self.path_to_ks_one_oh, session_file)
+        if find_probes==True:
+            self.get_files.get_probe_dirs(probes='all')
+            self.probe_dict = self.get_files.probe_data_dirs
         else:
-            session_file = os.path.join(self.main_folder, "kilosort_ultra_session.m")
-            if os.path.exists(session_file)==False:
-                shutil.copy(self.path_to_ks_ultra, session_file)
+            self.probe_dict = {}
+        self.path_to_ks_one_oh, self.path_to_ks_ultra = io.get_paths_to_kilosort_templates()
 
-        with open(session_file, "r") as f:
-            lines = f.readlines()
+    def get_probe_dir(self, recording, probe):
+        '''
+        Returns the data folder of a recording/probe, looking for folders again if it wasn't there before (eg it was still being transferred).
+        '''
+        with self.dirs_lock:
+            if probe not in self.probe_dict.get(recording, {}):
+                self.get_files.determine_recordings("all")
+                self.get_files.get_probe_dirs(probes='all')
+                self.probe_dict = self.get_files.probe_data_dirs
+            return self.probe_dict[recording][probe]
 
-        zline = [n for n,l in enumerate(lines) if "rootZ =" in l]
-        while len(zline) > 0:
-            for z in zline:
-                del lines[z]
-            zline = [n for n,l in enumerate(lines) if "rootZ =" in l]
+    def write_ks_file(self, probe_dir):
+        '''
+        Writes the kilosort script for one probe, kilosort_probe.m in probe_dir, from the 1.0 or ultra template, and returns its path.
+        The script sets rootZ to probe_dir and gives the probe its own temporary whitened data file, so any number of
+        engines or computers can sort probes of the same session at once. The template itself is only read.
+        '''
+        template = self.path_to_ks_one_oh if '.0' in probe_dir else self.path_to_ks_ultra
+        with open(template, "r") as f:
+            lines = [l for l in f.readlines() if "rootZ =" not in l]
 
-        text_insert = "rootZ = '{}';".format(probe_dir)
-        lines.insert(0, text_insert)
+        recording = os.path.basename(os.path.dirname(os.path.dirname(probe_dir)))
+        fproc_name = "temp_wh_{}_{}_{}.dat".format(self.session, recording, os.path.basename(probe_dir))
+        for n, l in enumerate(lines):
+            if l.strip().startswith("ops.fproc"):
+                lines[n] = "ops.fproc       = fullfile(rootH, '{}'); % proc file on a fast SSD, one per probe\n".format(fproc_name)
+        lines.insert(0, "rootZ = '{}';\n".format(probe_dir))
+        lines.append("\n\n% the temporary whitened data isn't needed once the probe is sorted\n")
+        lines.append("if exist(ops.fproc, 'file'), delete(ops.fproc); end\n")
 
-        with open(session_file, "w") as dest:
+        script_file = os.path.join(probe_dir, KS_SCRIPT_NAME)
+        with open(script_file + ".partial", "w") as dest:
             dest.writelines(lines)
+        os.replace(script_file + ".partial", script_file)
+        return script_file
 
-    def run_kilosort(self):
+    def decompress_dat(self, probe_dir):
+        '''
+        Kilosort needs the raw continuous.dat. If the probe only has the compressed continuous.cdat, writes continuous.dat
+        from it and returns True so it can be removed once kilosort is done, otherwise returns False.
+        '''
+        dat_file = os.path.join(probe_dir, 'continuous.dat')
+        if (os.path.exists(dat_file)==False) and os.path.exists(ct.compressed_path(dat_file)):
+            start = time.time()
+            print("decompressing {}".format(ct.compressed_path(dat_file)))
+            ct.decompress_dat(ct.compressed_path(dat_file), dat_file)
+            print("that took {}s".format(time.time()-start))
+            return True
+        return False
+
+    def get_engine_pool(self):
+        if self.engine_pool is None:
+            self.engine_pool = matlab_tools.get_engine_pool(self.n_engines)
+        return self.engine_pool
 
-        eng = matlab.engine.start_matlab()
-        eng.addpath(self.main_folder, nargout=0)
+    def call_kilosort(self, eng, script_file):
+        '''
+        Runs a probe's kilosort script (written by write_ks_file) on the MATLAB engine eng.
+        '''
+        eng.run(script_file, nargout=0)
 
+    def select_probes(self):
+        '''
+        Drops the recordings/probes not in recordings_to_run/probes_to_run from probe_dict and returns the (recording, probe) jobs left.
+        '''
         if self.recordings != 'all':
             remove_list = [key for key in self.probe_dict if key not in self.recordings]
             [self.probe_dict.pop(key, None) for key in self.probe_dict.copy().keys() if key not in self.recordings]
@@ -79,43 +144,198 @@ class RunKilosort():
                 tups = [(recording, p) for p in probes]
                 [self.probe_dict[t[0]].pop(t[1], None) for t in tups]
 
-        bad_dats = []
-        for recording_key in self.probe_dict:
-            for probe_key in self.probe_dict[recording_key]:
-                d = self.probe_dict[recording_key][probe_key]
-                skip_ks = self.get_files.get_kilosort_flag(recording_key, probe_key)
-
-                if (("rez.mat" in os.listdir(d))==False) and (skip_ks == False):
-                    self.write_ks_file(probe_dir=d)
-
-                    try:
-                        start = time.time()
-                        print('starting kilosort on {} {}'.format(d.split("\\")[6], d.split('\\')[-1]))
-                        eng.cd(self.main_folder)
-                        if ".0" in d:
-                            eng.kilosort_one_oh_session(nargout=0)
-                        else:
-                            eng.kilosort_ultra_session(nargout=0)
-                        end = time.time()
-                        print("done with kilosort. that took {}s".format(end-start))
-                    except Exception as e:
-                        now = datetime.strftime(datetime.now(), '%Y%m%d-%H%M')
-                        bad_dats.append("{} {} {}".format(now, d, e))
-                        self.get_files.make_flags_json(recording_key,
-                                                        probe_key,
-                                                        text = "failed kilosort",
-                                                        skip_kilosort = True,)
-                        pass
-
-                elif ("rez.mat" in os.listdir(d))==True:
-                    print("{} {} has already been processed. Delete rez.mat to reprocess.".format(d.split("\\")[6], d.split('\\')[-1]))
-                elif skip_ks == True:
-                    print("Skipping {} {} because of flags file: {}".format(d.split("\\")[6], d.split('\\')[-1], flags['other_notes']))
+        return [(recording_key, probe_key) for recording_key in self.probe_dict for probe_key in self.probe_dict[recording_key]]
+
+    def add_to_queue(self):
+        '''
+        Adds the session's recordings/probes to the kilosort queue without sorting them, for drain_queue to pick up.
+        '''
+        if len(self.probe_dict) == 0:
+            self.get_all_file_locations()
+        for recording_key, probe_key in self.select_probes():
+            self.queue.add(self.session, recording_key, probe_key, self.probe_dict[recording_key][probe_key], self.priority)
+        print("kilosort queue: {}".format(self.queue.counts()))
 
+    def run_kilosort(self):
+        jobs = self.select_probes()
+        if self.n_engines > 1:
+            with ThreadPoolExecutor(max_workers=self.n_engines) as pool:
+                results = list(pool.map(lambda job: self.run_until_done(*job), jobs))
+        else:
+            results = [self.run_until_done(recording_key, probe_key) for recording_key, probe_key in jobs]
+        print("kilosort queue: {}".format(self.queue.counts()))
+        return results
+
+    def run_until_done(self, recording_key, probe_key):
+        '''
+        Runs a recording/probe again while it fails and has attempts left. Returns the last result of run_probe.
+        '''
+        result = self.run_probe(recording_key, probe_key)
+        while result == 'retry':
+            result = self.run_probe(recording_key, probe_key)
+        return result
+
+    def run_probe(self, recording_key, probe_key, eng=None, job=None):
+        '''
+        Makes one attempt at sorting a recording/probe, unless it's already sorted or flagged to skip, and records it in the queue.
+        Runs on the MATLAB engine eng if given, otherwise on one from the engine pool.
+        job is the queue job if it was already claimed from the queue (see drain_queue).
+        A failed attempt is put back in the queue while it has attempts left; the last failure is flagged and written to bad_dat_files.txt.
+        Returns 'sorted', 'already sorted', 'skipped', 'retry', 'failed', or 'running' if it's already being sorted by another process.
+        '''
+        d = self.get_probe_dir(recording_key, probe_key)
+        skip_ks = self.get_files.get_kilosort_flag(recording_key, probe_key)
+        skip_note = None
+        if job is None:
+            self.queue.add(self.session, recording_key, probe_key, d, self.priority)
+        if (("rez.mat" in os.listdir(d))==False) and (skip_ks == False) and (self.validate==True):
+            try:
+                skip_note = self.validate_probe(recording_key, probe_key, d)
+                skip_ks = skip_note is not None
+            except Exception as e:
+                if job is None:
+                    raise
+                # the job was claimed from the queue, don't leave it running
+                return self.fail_job(recording_key, probe_key, d, job, e)
+            except BaseException:
+                if job is not None:
+                    self.queue.release(job)
+                raise
+
+        if (("rez.mat" in os.listdir(d))==False) and (skip_ks == False):
+            if job is None:
+                job = self.queue.start(self.session, recording_key, probe_key)
+                if job is None:
+                    print("{} {} is already being sorted.".format(d.split("\\")[6], d.split('\\')[-1]))
+                    return 'running'
+            decompressed = False
+            status = 'sorted'
+            try:
+                decompressed = self.decompress_dat(d)
+                script_file = self.write_ks_file(probe_dir=d)
+                start = time.time()
+                print('starting kilosort on {} {}'.format(d.split("\\")[6], d.split('\\')[-1]))
+                if eng is None:
+                    with self.get_engine_pool().engine() as pool_eng:
+                        self.call_kilosort(pool_eng, script_file)
+                else:
+                    self.call_kilosort(eng, script_file)
+                end = time.time()
+                print("done with kilosort. that took {}s".format(end-start))
+                self.queue.finish(job)
+            except Exception as e:
+                status = self.fail_job(recording_key, probe_key, d, job, e)
+            except BaseException:
+                # interrupted (eg Ctrl-C), not a failure of the job, so it's put back for the next run
+                self.queue.release(job)
+                raise
+            finally:
+                if (decompressed==True) and os.path.exists(os.path.join(d, 'continuous.dat')):
+                    os.remove(os.path.join(d, 'continuous.dat'))
+            return status
+
+        elif ("rez.mat" in os.listdir(d))==True:
+            print("{} {} has already been processed. Delete rez.mat to reprocess.".format(d.split("\\")[6], d.split('\\')[-1]))
+            self.queue.finish(self.queue_job(recording_key, probe_key, job), 'done', 'already sorted')
+            return 'already sorted'
+        elif skip_ks == True:
+            note = self.get_flag_note(d) if skip_note is None else skip_note
+            print("Skipping {} {}: {}".format(d.split("\\")[6], d.split('\\')[-1], note))
+            self.queue.finish(self.queue_job(recording_key, probe_key, job), 'skipped', note)
+            return 'skipped'
+
+    def fail_job(self, recording_key, probe_key, probe_dir, job, error):
+        '''
+        Records a failed attempt at a running job. Returns 'retry' if the job has attempts left, otherwise flags the
+        probe, writes the error to bad_dat_files.txt and returns 'failed'.
+        '''
+        if self.queue.fail(job, error)=='pending':
+            print("kilosort failed on attempt {} of {}, trying again later: {}".format(job['attempts'], job['max_attempts'], error))
+            return 'retry'
+        self.get_files.make_flags_json(recording_key,
+                                        probe_key,
+                                        text = "failed kilosort {} times".format(job['attempts']),
+                                        skip_kilosort = True,)
+        now = datetime.strftime(datetime.now(), '%Y%m%d-%H%M')
+        with self.dirs_lock:
             with open(self.bad_dats_txt, 'a') as f:
-                for line in bad_dats:
-                    f.write(line + "\n")
+                f.write("{} {} {}\n".format(now, probe_dir, error))
+        return 'failed'
+
+    def validate_probe(self, recording_key, probe_key, probe_dir):
+        '''
+        Runs validation_tools.validate_dat on a probe's data. If it fails, writes the problems to bad_dat_files.txt and,
+        if they're problems with the data itself, flags the probe to skip kilosort. Problems that can go away without
+        the data changing (timestamps.npy isn't there yet) only skip this run, the probe is validated again next time.
+        Returns why the probe should be skipped, or None if it passed.
+        '''
+        report = validation_tools.validate_dat(probe_dir)
+        if report['passed']==True:
+            return None
+        text = "failed validation: {}".format("; ".join(report['problems']))
+        if report['final']==True:
+            self.get_files.make_flags_json(recording_key, probe_key, text=text, skip_kilosort=True)
+        else:
+            text += " (not flagged, validated again on the next run)"
+        now = datetime.strftime(datetime.now(), '%Y%m%d-%H%M')
+        with self.dirs_lock:
+            with open(self.bad_dats_txt, 'a') as f:
+                f.write("{} {} {}\n".format(now, probe_dir, text))
+        return text
+
+    def queue_job(self, recording_key, probe_key, job=None):
+        if job is None:
+            job = {'session': self.session, 'recording': recording_key, 'probe': probe_key}
+        return job
+
+    def get_flag_note(self, probe_dir):
+        '''
+        Notes written in a probe's flags.json, ie why it's skipped.
+        '''
+        flags_file = os.path.join(probe_dir, 'flags.json')
+        if os.path.exists(flags_file)==False:
+            return None
+        with open(flags_file, 'r') as f:
+            flags = json.load(f)
+        return flags.get('other notes', flags.get('other_notes'))
+
+
+def drain_queue(n_engines=1, queue_file=None, max_attempts=2):
+    '''
+    Sorts pending jobs from the kilosort queue, of every session, highest priority first, until the queue is empty.
+    Keeps n_engines probes sorting at once so the sorting computer stays busy. Sessions are queued with
+    RunKilosort(date, mouse_id, run_now=False).add_to_queue(), or by any earlier run that left jobs to retry.
+    The queue is on this computer's disk by default, so it's drained by the computer the sessions were queued on.
+    queue_file can point somewhere else, but only one computer may use a queue file.
+    '''
+    computer_names = io.read_computer_names()
+    if queue_file is None:
+        queue_file = io.get_local_state_file(QUEUE_NAME, computer_names)
+    queue = kilosort_tools.KilosortQueue(queue_file, max_attempts)
+    queue.requeue_stale()
+    queue.requeue_orphaned()
+    runners = {}
+    runners_lock = threading.Lock()
+
+    def worker():
+        job = queue.claim()
+        while job is not None:
+            date, mouse_id = job['session'].split('_', 1)
+            with runners_lock:
+                if job['session'] not in runners:
+                    runners[job['session']] = RunKilosort(date, mouse_id, run_now=False, n_engines=n_engines, queue=queue)
+                runner = runners[job['session']]
+            try:
+                runner.run_probe(job['recording'], job['probe'], job=job)
+            except Exception as e:
+                print("---------{} {} {} failed: {}---------".format(job['session'], job['recording'], job['probe'], e))
+                queue.fail(job, e)
+            job = queue.claim()
 
+    with ThreadPoolExecutor(max_workers=n_engines) as pool:
+        for n in range(n_engines):
+            pool.submit(worker)
+    print("kilosort queue: {}".format(queue.counts()))
 
 if __name__ == "__main__":
     import argparse
@@ -124,6 +344,18 @@ if __name__ == "__main__":
     parser.add_argument('mouse_id', type=str)
     parser.add_argument('--probes_to_run', nargs="+", default='all')
     parser.add_argument('--recordings_to_run', nargs="+", default='all')
+    parser.add_argument('--n_engines', type=int, default=1)
+    parser.add_argument('--max_attempts', type=int, default=2)
+    parser.add_argument('--priority', type=int, default=0)
+    parser.add_argument('--no_validate', action='store_true', help="don't check continuous.dat files before sorting them")
+    parser.add_argument('--queue_only', action='store_true', help="add the session to the kilosort queue without sorting it")
+    parser.add_argument('--drain', action='store_true', help="then sort everything pending in the kilosort queue")
     args = parser.parse_args()
 
-    RunKilosort(args.date, args.mouse_id, args.probes_to_run, args.recordings_to_run)
+    run_now = (args.queue_only==False) and (args.drain==False)
+    ks = RunKilosort(args.date, args.mouse_id, args.probes_to_run, args.recordings_to_run, run_now=run_now, n_engines=args.n_engines,
+                    max_attempts=args.max_attempts, priority=args.priority, validate=(args.no_validate==False))
+    if run_now==False:
+        ks.add_to_queue()
+    if args.drain==True:
+        drain_queue(args.n_engines, max_attempts=args.max_attempts)
@@ -0,0 +1,256 @@
+import os
+import glob2
+import fnmatch
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from np2_ultra.scripts import transfer, kilosort, waveforms
+from np2_ultra.tools import io
+import np2_ultra.tools.compress_tools as ct
+
+KILOSORT_OUTPUTS = ['rez.mat', 'spike_times.npy', 'spike_clusters.npy', 'cluster_KSLabel.tsv', 'channel_map.npy']
+RECORDING_FILES = ['*sync.h5', '*opto.pkl', 'timestamps.npy']
+PROBE_FILES = ['continuous.dat', ct.COMPRESSED_NAME, 'timestamps.npy']
+
+
+class SessionPipeline():
+    """
+    Runs transfer, kilosort and waveform extraction on a session with the stages overlapping.
+    Each recording/probe is a unit of work: kilosort starts on it as soon as its continuous.dat and timestamps.npy have
+    been transferred and checked against the transfer manifest (or once the transfer is done, if it has no timestamps.npy), and waveform extraction starts as soon as kilosort's output for it exists and
+    its recording's sync, opto, timestamps and event files have been transferred, while the rest of the session may
+    still be copying. Each stage has its own number of jobs.
+
+    Methods
+    ----------
+    run_it()
+    file_transferred(src, rel_path, copied)
+    queue_kilosort(recording, probe)
+    run_kilosort(recording, probe)
+    queue_waveforms(recording, probe)
+    run_waveforms(recording, probe)
+    recording_ready(recording)
+    wait_for_recording(recording)
+    run_stage(stage, recording, probe)
+    """
+    def __init__(self, date, mouse_id, probes_to_run='all', recordings_to_run='all', kilosort_jobs=1, waveform_jobs=1, transfer_kwargs=None, waveform_kwargs=None):
+        """
+        Parameters
+        ----------
+        date: str
+            The date of the session in YYYY-MM-DD format
+        mouse_id: str
+            The 6 digit mouse number
+        probes_to_run: list of strings, optional
+            Probe letters to sort and extract, eg ['C', 'E']. All probes are still transferred. default runs all
+        recordings_to_run: list of strings, optional
+            Recordings to sort and extract, eg ['recording2']. All recordings are still transferred. default runs all
+        kilosort_jobs: int, optional
+            Number of recording/probes sorted at once, each on one of the process's kilosort_jobs warm MATLAB engines. default = 1
+        waveform_jobs: int, optional
+            Number of recording/probes extracted at once. default = 1
+        transfer_kwargs: dict, optional
+            Extra arguments for transfer.TransferFiles, eg {'destination': [('dest_root', 'np2_data'), ('backup_drive', '')]}
+        waveform_kwargs: dict, optional
+            Extra arguments for waveforms.GetWaveforms, eg {'n_workers': 4}
+        """
+        self.date = date
+        self.mouse_id = mouse_id
+        self.probes = probes_to_run
+        self.recordings = recordings_to_run
+        self.kilosort_jobs = kilosort_jobs
+        self.waveform_jobs = waveform_jobs
+        self.transfer_kwargs = {} if transfer_kwargs is None else transfer_kwargs
+        self.waveform_kwargs = {} if waveform_kwargs is None else waveform_kwargs
+        self.pxi_dict = io.read_pxi_dict()
+
+        self.lock = threading.Lock()
+        self.waveform_lock = threading.Lock()
+        self.loop_lock = threading.Lock()
+        self.transfer_done = threading.Event()
+        self.recording_condition = threading.Condition()
+        self.status = {}
+        self.probe_files = {}
+        self.futures = []
+        self.waveform_runner = None
+        self.recording_states = {}
+
+    def run_it(self):
+        """
+        Runs the whole session and prints the status of every recording/probe at the end.
+        """
+        start = time.time()
+        self.transfer = transfer.TransferFiles(self.date, self.mouse_id, **self.transfer_kwargs)
+        self.kilosort = kilosort.RunKilosort(self.date, self.mouse_id, run_now=False, n_engines=self.kilosort_jobs)
+        self.transfer.engine.add_callback(self.file_transferred)
+        self.kilosort_pool = ThreadPoolExecutor(max_workers=self.kilosort_jobs)
+        self.waveform_pool = ThreadPoolExecutor(max_workers=self.waveform_jobs)
+
+        try:
+            self.transfer.run_it()
+            # probes whose data was already in place without going through the transfer engine
+            for recording in sorted(os.listdir(self.transfer.main_folder)):
+                continuous_dir = os.path.join(self.transfer.main_folder, recording, 'continuous')
+                if ('recording' in recording) and os.path.isdir(continuous_dir):
+                    for folder in sorted(os.listdir(continuous_dir)):
+                        probe = self.probe_letter(folder)
+                        data_dir = os.path.join(continuous_dir, folder)
+                        if (probe is not None) and (os.path.exists(os.path.join(data_dir, 'continuous.dat')) or os.path.exists(os.path.join(data_dir, ct.COMPRESSED_NAME))):
+                            self.queue_kilosort(recording, probe)
+            self.transfer_done.set()
+            self.notify_recordings()
+
+            n_done = 0
+            while n_done < len(self.futures):
+                with self.lock:
+                    futures = list(self.futures)
+                for future in futures[n_done:]:
+                    future.result()
+                n_done = len(futures)
+        finally:
+            self.transfer_done.set()
+            self.notify_recordings()
+            self.kilosort_pool.shutdown()
+            self.waveform_pool.shutdown()
+
+        print("------DONE PROCESSING {}_{} in {} seconds--------".format(self.date, self.mouse_id, time.time()-start))
+        for unit in sorted(self.status.keys()):
+            print("{} {}: {}".format(unit[0], unit[1], self.status[unit]))
+
+    def probe_letter(self, folder):
+        """Probe letter of a spike band Neuropix-PXI folder, or None for other folders."""
+        if 'Neuropix' not in folder:
+            return None
+        return self.pxi_dict['reverse'].get(folder[-2:])
+
+    def file_transferred(self, src, rel_path, copied):
+        """
+        Transfer engine callback. Queues kilosort for the recording/probe once its continuous.dat (or continuous.cdat)
+        and timestamps.npy are in place and match the manifest, so validation can check the data's length, and wakes
+        waveform jobs waiting for their recording's files.
+        """
+        self.notify_recordings()
+        parts = rel_path.replace('\\', '/').split('/')
+        if (len(parts) != 4) or (parts[1] != 'continuous') or (parts[3] not in PROBE_FILES):
+            return
+        probe = self.probe_letter(parts[2])
+        if probe is None:
+            return
+        if all([manifest.verify(rel_path) for manifest in self.transfer.engine.manifests])==False:
+            print("---------{} doesn't match the transfer manifest, not sorting it---------".format(rel_path))
+            return
+        with self.lock:
+            arrived = self.probe_files.setdefault((parts[0], probe), set())
+            arrived.add('timestamps' if parts[3] == 'timestamps.npy' else 'data')
+            ready = len(arrived) == 2
+        if ready==True:
+            self.queue_kilosort(parts[0], probe)
+
+    def queue_kilosort(self, recording, probe):
+        """Submits a recording/probe to the kilosort stage, once."""
+        if ((self.recordings != 'all') and (recording not in self.recordings)) or ((self.probes != 'all') and (probe not in self.probes)):
+            return
+        with self.lock:
+            if (recording, probe) in self.status:
+                return
+            self.status[(recording, probe)] = 'waiting for kilosort'
+            self.futures.append(self.kilosort_pool.submit(self.run_stage, self.run_kilosort, recording, probe))
+
+    def run_stage(self, stage, recording, probe):
+        """Runs a stage job, recording an error as the recording/probe's status so the other units carry on."""
+        try:
+            stage(recording, probe)
+        except Exception as e:
+            print("---------{} {} failed in {}: {}---------".format(recording, probe, stage.__name__, e))
+            self.status[(recording, probe)] = 'error in {}: {}'.format(stage.__name__, e)
+
+    def run_kilosort(self, recording, probe):
+        """Kilosort stage job, retried while it fails and has attempts left in the kilosort queue. Queues waveform extraction if the probe was sorted."""
+        self.status[(recording, probe)] = 'kilosort'
+        result = self.kilosort.run_until_done(recording, probe)
+        data_dir = self.kilosort.get_probe_dir(recording, probe)
+        if (result in ['sorted', 'already sorted']) and all([os.path.exists(os.path.join(data_dir, f)) for f in KILOSORT_OUTPUTS]):
+            self.queue_waveforms(recording, probe)
+        else:
+            self.status[(recording, probe)] = 'kilosort {}'.format(result)
+
+    def queue_waveforms(self, recording, probe):
+        """Submits a recording/probe to the waveform stage."""
+        with self.lock:
+            self.status[(recording, probe)] = 'waiting for waveforms'
+            self.futures.append(self.waveform_pool.submit(self.run_stage, self.run_waveforms, recording, probe))
+
+    def notify_recordings(self):
+        with self.recording_condition:
+            self.recording_condition.notify_all()
+
+    def recording_ready(self, recording):
+        """
+        True once the recording's sync, opto and timestamps files are in place and none of them, or of its event
+        files, is still copying. Other files of the recording (continuous data, videos) aren't waited for.
+        """
+        if self.transfer.recording_files_queued.is_set()==False:
+            return False
+        recording_dir = os.path.join(self.transfer.main_folder, recording)
+        if any([len(glob2.glob(os.path.join(recording_dir, pattern))) == 0 for pattern in RECORDING_FILES]):
+            return False
+        for src, dst, future in list(self.transfer.engine.jobs):
+            parts = os.path.relpath(dst, self.transfer.main_folder).replace('\\', '/').split('/')
+            if (parts[0] != recording) or (len(parts) < 2) or future.done():
+                continue
+            if (parts[1] == 'events') or ((len(parts) == 2) and any([fnmatch.fnmatch(parts[1], pattern) for pattern in RECORDING_FILES])):
+                return False
+        return True
+
+    def wait_for_recording(self, recording):
+        """
+        Waits until recording_ready(recording), woken by the transfer callbacks.
+        Raises IOError if the transfer finished without the recording's files.
+        """
+        with self.recording_condition:
+            while self.recording_ready(recording)==False:
+                if self.transfer_done.is_set():
+                    raise IOError("{} is missing its sync, opto or timestamps file".format(recording))
+                self.recording_condition.wait(timeout=2)
+
+    def run_waveforms(self, recording, probe):
+        """
+        Waveform stage job. Waits for the recording's sync, opto, timestamps and event files (not the whole session).
+        The recording's sync and opto data are loaded once and shared by its probes. Probes extracted in loop mode
+        are run one at a time.
+        """
+        self.wait_for_recording(recording)
+        with self.waveform_lock:
+            if self.waveform_runner is None:
+                self.waveform_runner = waveforms.GetWaveforms(self.date, self.mouse_id, self.probes, self.recordings, **self.waveform_kwargs)
+            recording_state = self.recording_states.get(recording)
+            if (recording_state is None) or (probe not in recording_state.probe_alignments):
+                probes = [p for p in self.waveform_runner.probe_data_dirs[recording].keys() if (recording, p) in self.status]
+                recording_state = self.waveform_runner.get_recording_state(recording, probes)
+                self.recording_states[recording] = recording_state
+        self.status[(recording, probe)] = 'waveforms'
+        if recording_state.extraction_params['extraction_mode'] == 'loop':
+            # loop mode draws from numpy's global random state, so its probes run one at a time like in GetWaveforms.run_it
+            with self.loop_lock:
+                recording_state.run_probe(recording, probe)
+        else:
+            recording_state.run_probe(recording, probe)
+        self.status[(recording, probe)] = 'done'
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('date', type=str)
+    parser.add_argument('mouse_id', type=str)
+    parser.add_argument('--probes_to_run', nargs="+", default='all')
+    parser.add_argument('--recordings_to_run', nargs="+", default='all')
+    parser.add_argument('--kilosort_jobs', type=int, default=1)
+    parser.add_argument('--waveform_jobs', type=int, default=1)
+    parser.add_argument('--n_workers', type=int, default=1)
+    args = parser.parse_args()
+
+    SessionPipeline(args.date, args.mouse_id, args.probes_to_run, args.recordings_to_run,
+                    kilosort_jobs=args.kilosort_jobs, waveform_jobs=args.waveform_jobs,
+                    waveform_kwargs={'n_workers': args.n_workers}).run_it()
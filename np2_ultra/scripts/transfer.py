@@ -2,10 +2,12 @@ import os
 import glob2
 from datetime import datetime
 import time
-import shutil
 import json
+import threading
 
 import np2_ultra.files as files
+from np2_ultra.tools import transfer_tools
+import np2_ultra.tools.compress_tools as ct
 
 class TransferFiles():
     """
@@ -20,10 +22,14 @@ class TransferFiles():
     xfer_brain_imgs()
     xfer_params_file()
     get_date_modified(self, file_path, date_format=False)
+    get_source_index(computer)
+    copy_file(src, dst, compress=False)
+    copy_data_file(src, dst)
+    copy_tree(src_dir, dst_dir)
 
     """
 
-    def __init__(self, date, mouse_id, destination=('dest_root', 'np2_data'), openephys_folder='false', path_to_files=None):
+    def __init__(self, date, mouse_id, destination=('dest_root', 'np2_data'), openephys_folder='false', path_to_files=None, n_threads=4, incremental=False, verify=False, compress=False):
         '''
         Parameters
         ----------
@@ -31,8 +37,10 @@ class TransferFiles():
             The date of the session in YYYY-MM-DD format
         mouse_id: str
             The 6 digit mouse number
-        destination: tuple, optional
+        destination: tuple or list of tuples, optional
             First value is key in np2_comp_names json, second value is optional, can be a sub-folder. default = ('dest_root', 'np2_data')
+            A list of tuples copies the session to all of them at once, reading each file from the rig computers only once.
+            The first one is the main destination.
         openephys_folder: str, optional
             Specifies a specific folder on the ACQ drive to read from, or 'false' to read the only folder with the specified date. Not typically used.
             default = 'false'
@@ -40,7 +48,27 @@ class TransferFiles():
             Can be relative or exact. path to where comp_names json and kilosort template files are located. Not typically used.
             If None, will use the relative path of folder 'files' located one directory up from current.
             default = None
+        n_threads: int, optional
+            Largest number of files copied at once from each rig computer during run_it. default = 4
+        incremental: bool, optional
+            If True, don't skip steps because their files seem to be in the destination already (a recording folder, a sync file, etc.).
+            Instead every source file is checked against the destination by size and modified time and only new or changed files are copied,
+            so rerunning on a partly transferred session only copies what's missing. Always True with more than one destination.
+            default = False
+        verify: bool, optional
+            Re-read every copied file and compare its checksum with the source's. default = False only checks the size of each copy
+        compress: bool, optional
+            Store each probe's continuous.dat as a losslessly compressed continuous.cdat instead of copying it as is (see compress_tools).
+            GetFiles.get_raw_data reads the compressed file directly and kilosort decompresses it when it's needed.
+            An interrupted compression resumes from its last journaled chunk, like a plain copy. default = False
         '''
+        self.n_threads = n_threads
+        self.incremental = incremental
+        self.compress = compress
+        self.queue_transfers = False
+        # set once the sync and opto files of every recording have been queued, see pipeline.SessionPipeline
+        self.recording_files_queued = threading.Event()
+        self.source_indexes = {}
 
         if path_to_files==None:
             self.path_to_files = os.path.dirname(files.__file__)
@@ -61,11 +89,20 @@ class TransferFiles():
         else:
             self.date = date
 
-        self.destination_folder = os.path.join(self.computer_names[destination[0]], destination[1])
-        self.main_folder = os.path.join(self.destination_folder, self.date +'_' + self.mouse_id)
-        if os.path.exists(self.main_folder)==False:
-            os.mkdir(self.main_folder)
+        if isinstance(destination[0], (list, tuple))==False:
+            destination = [destination]
+        self.destination_folders = [os.path.join(self.computer_names[d[0]], d[1]) for d in destination]
+        self.main_folders = [os.path.join(folder, self.date +'_' + self.mouse_id) for folder in self.destination_folders]
+        for folder in self.main_folders:
+            if os.path.exists(folder)==False:
+                os.mkdir(folder)
+        self.destination_folder = self.destination_folders[0]
+        self.main_folder = self.main_folders[0]
+        if len(self.main_folders) > 1:
+            #the checks for files already in the destination only look at the main destination
+            self.incremental = True
         self.bad_dats_txt = os.path.join(self.main_folder, "bad_dat_files.txt")
+        self.engine = transfer_tools.TransferEngine(self.main_folders, threads_per_host=self.n_threads, verify=verify)
 
         #codeblock below pertains to running more than one experiment in a day -- can otherwise be ignored
         if openephys_folder != 'false':
@@ -73,7 +110,7 @@ class TransferFiles():
         else:
             self.specify_folder = False
         self.multiple_experiments = False
-        potential_folders = [f for f in os.listdir(self.computer_names['acq']) if self.date in f]
+        potential_folders = self.get_source_index('acq').matching('*{}*'.format(self.date))
         if len(potential_folders) > 1:
             self.multiple_experiments=True
             if self.specify_folder==False:
@@ -85,20 +122,50 @@ class TransferFiles():
     def run_it(self):
         """
         Runs data transfer to specified location for entire session.
+        Files from different rig computers, and up to n_threads files from the same computer, are copied at the same time.
+        Raises IOError if any file failed to copy (the failures are kept in self.failed), so later steps don't run on a partial session.
         if __name__ == __main__ automatically calls this function.
         """
         print("date: {}, mouse: {}".format(self.date, self.mouse_id))
         print("looking in {}".format(self.computer_names['acq']))
         print("------TRANSFERRING ALL FILES--------")
-        print("transferring to {}".format(self.destination_folder))
+        print("transferring to {}".format(', '.join(self.destination_folders)))
+        self.queue_transfers = True
         self.xfer_ephys_data()
         self.xfer_sync_data()
         self.xfer_opto_data()
+        self.recording_files_queued.set()
         self.xfer_behavior_videos()
         self.xfer_brain_imgs()
         self.xfer_params_file()
+        print("------WAITING FOR QUEUED TRANSFERS--------")
+        self.failed = self.engine.wait()
+        self.queue_transfers = False
+        if len(self.failed) > 0:
+            raise IOError("{} files failed to transfer for {}_{}: {}".format(len(self.failed), self.date, self.mouse_id,
+                                                                            ', '.join([src for src, dst, e in self.failed])))
         print("------DONE TRANSFERRING FILES {}_{}--------".format(self.date, self.mouse_id))
 
+    def get_source_index(self, computer):
+        """
+        Returns the SourceIndex of a rig computer's folder (a key in computer_names.json), scanning it the first time it's asked for.
+        """
+        if computer not in self.source_indexes:
+            self.source_indexes[computer] = transfer_tools.SourceIndex(self.computer_names[computer])
+        return self.source_indexes[computer]
+
+    def get_stat(self, file_path):
+        """
+        Stat result of a file, taken from the source indexes if its folder has been scanned.
+        """
+        for index in self.source_indexes.values():
+            if os.path.normpath(os.path.dirname(file_path)) == os.path.normpath(index.folder):
+                try:
+                    return index.stat(file_path)
+                except KeyError:
+                    break
+        return os.stat(file_path)
+
     def get_date_modified(self, file_path, date_format=False):
         """
         Get the date a file was last modified. Currently used to ID the correct sync files.
@@ -108,64 +175,109 @@ class TransferFiles():
         date_format: str, optional
             Can optionally return the date as a string of the specified format, using standard datetime format codes. Default None returns a datetime timestamp object.
         """
-        timestamp = datetime.fromtimestamp(os.stat(file_path).st_mtime)
+        timestamp = datetime.fromtimestamp(self.get_stat(file_path).st_mtime)
         if date_format != False:
             timestamp = datetime.strftime(timestamp, date_format)
         return timestamp
 
+    def copy_file(self, src, dst, compress=False):
+        """
+        Copies src to dst through the transfer engine, which resumes interrupted copies and records each file in the
+        session's transfer_manifest.json. dst is a path in the main destination; with more than one destination the file
+        is read once and also written to the same place in the others.
+        During run_it the copy is queued, otherwise it's copied right away.
+        If compress, src is a continuous.dat that is written compressed to dst.
+        """
+        rel_path = os.path.relpath(dst, self.main_folder)
+        if self.queue_transfers==True:
+            self.engine.submit(src, rel_path, compress)
+        else:
+            self.engine.transfer(src, rel_path, compress)
+
+    def copy_data_file(self, src, dst):
+        """
+        copy_file for files in the recording folders: continuous.dat files are stored compressed if self.compress.
+        """
+        if (self.compress==True) and (os.path.basename(src) == 'continuous.dat'):
+            self.copy_file(src, ct.compressed_path(dst), compress=True)
+        else:
+            self.copy_file(src, dst)
+
+    def copy_tree(self, src_dir, dst_dir):
+        """
+        Copies every file under src_dir to the same place under dst_dir through copy_file.
+        The destination folders are created right away so later steps can find them while files are still copying.
+        In incremental mode the source and each destination are listed once and only files that are new or changed
+        in at least one destination are copied.
+        """
+        if self.incremental==True:
+            src_manifest = transfer_tools.build_manifest(src_dir)
+            rel_dir = os.path.relpath(dst_dir, self.main_folder)
+            changed = set()
+            for main_folder, manifest in zip(self.main_folders, self.engine.manifests):
+                dest_changed, dest_unchanged = transfer_tools.diff_manifests(src_manifest, transfer_tools.build_manifest(os.path.join(main_folder, rel_dir)))
+                changed.update(dest_changed)
+                untracked = {}
+                for rel_path in dest_unchanged:
+                    if manifest.key(os.path.join(rel_dir, rel_path)) not in manifest.entries:
+                        untracked[os.path.join(rel_dir, rel_path)] = dict(src_manifest[rel_path], crc32=None)
+                if len(untracked) > 0:
+                    manifest.update_many(untracked)
+            for rel_path in sorted(changed):
+                for main_folder in self.main_folders:
+                    os.makedirs(os.path.dirname(os.path.join(main_folder, rel_dir, rel_path)), exist_ok=True)
+                self.copy_data_file(os.path.join(src_dir, rel_path), os.path.join(dst_dir, rel_path))
+            print("{}: {} files to copy, {} already up to date".format(os.path.basename(dst_dir), len(changed), len(src_manifest)-len(changed)))
+            return
+
+        for root, dirs, file_names in os.walk(src_dir):
+            dest_root = os.path.join(dst_dir, os.path.relpath(root, src_dir))
+            os.makedirs(dest_root, exist_ok=True)
+            for file_name in file_names:
+                self.copy_data_file(os.path.join(root, file_name), os.path.join(dest_root, file_name))
+
     def xfer_ephys_data(self):
         """
         Tranfer session output from Open Ephys, as well as make a copy of one timestamp.npy file per recording.
+        Recording folders are copied straight to their recordingN names.
+        The source is always walked; files the transfer manifest shows are already in place are skipped, so an
+        interrupted transfer picks up every file that's missing, including ones that hadn't started.
         """
         start = time.time()
         print("Transferring ephys data.")
 
-        if len(glob2.glob(os.path.join(self.main_folder, 'recording*'))) == 0:
-            transfer_ephys_data = True
-        else:
-            transfer_ephys_data = False
-
-        if transfer_ephys_data==True:
-            data_folders = glob2.glob(os.path.join(self.computer_names['acq'], "*{}*".format(self.date), '**', 'experiment1'))
+        rename_dict = {0: 'recording1', 1: 'recording2', 2:'recording3', 3: 'recording4', 4: 'recording5'}
+        data_folders = []
+        for session_folder in self.get_source_index('acq').matching("*{}*".format(self.date)):
+            data_folders.extend(glob2.glob(os.path.join(session_folder, '**', 'experiment1')))
 
-            if (len(data_folders) > 1) & (self.specify_folder==False):
-                print("There is more than one experiment for this day. Please specify which one you'd like to process using the openephys_folder argument:\n{}".format(data_folders))
+        if (len(data_folders) > 1) & (self.specify_folder==False):
+            print("There is more than one experiment for this day. Please specify which one you'd like to process using the openephys_folder argument:\n{}".format(data_folders))
+            return
+        elif (len(data_folders) > 1) & (self.specify_folder!=False):
+            try:
+                data_loc = [f for f in data_folders if self.specify_folder in f][0]
+            except IndexError:
+                print("The open ephys folder you specified does not exist. Check the name and try again.")
                 return
-            elif (len(data_folders) > 1) & (self.specify_folder!=False):
-                try:
-                    data_loc = [f for f in data_folders if self.specify_folder in f][0]
-                except IndexError:
-                    print("The open ephys folder you specified does not exist. Check the name and try again.")
-                    return
-            else:
-                data_loc = data_folders[0]
-
-            transfer_loc = self.main_folder
-            xml_file = os.path.join(os.path.dirname(data_loc), "settings.xml")
-            shutil.copy(xml_file, os.path.join(transfer_loc, "settings.xml"))
-
-            for file in os.listdir(data_loc):
-                if "recording" in file:
-                    fol = os.path.join(data_loc, file)
-                    shutil.copytree(fol, os.path.join(transfer_loc, file))
-                    print("{} transfered".format(file))
         else:
-            print("Ephys data already transferred.")
-
-        rename_dict = {0: 'recording1', 1: 'recording2', 2:'recording3', 3: 'recording4', 4: 'recording5'}
-        for n, name in enumerate(glob2.glob(os.path.join(self.main_folder, 'recording*'))):
-            if "recording" in name:
-                old = name
-                new = os.path.join(os.path.dirname(name), rename_dict[n])
-                try:
-                    os.rename(old, new)
-                except FileExistsError:
-                    pass
-                try:
-                    probeA_timestamps = glob2.glob(os.path.join(new, 'continuous', 'Neuropix-PXI-*.0', 'timestamps.npy'))[0]
-                    shutil.copy(probeA_timestamps, new)
-                except:
-                    print("---------{} timestamps file couldn't be moved.---------".format(rename_dict[n]))
+            data_loc = data_folders[0]
+
+        transfer_loc = self.main_folder
+        xml_file = os.path.join(os.path.dirname(data_loc), "settings.xml")
+        self.copy_file(xml_file, os.path.join(transfer_loc, "settings.xml"))
+
+        recording_folders = sorted([file for file in os.listdir(data_loc) if "recording" in file])
+        for n, file in enumerate(recording_folders):
+            fol = os.path.join(data_loc, file)
+            new = os.path.join(transfer_loc, rename_dict[n])
+            self.copy_tree(fol, new)
+            try:
+                probeA_timestamps = glob2.glob(os.path.join(fol, 'continuous', 'Neuropix-PXI-*.0', 'timestamps.npy'))[0]
+                self.copy_file(probeA_timestamps, os.path.join(new, 'timestamps.npy'))
+            except IndexError:
+                print("---------{} timestamps file couldn't be moved.---------".format(rename_dict[n]))
+            print("{} transferring to {}".format(file, rename_dict[n]))
 
         end = time.time()
         print("That took {} seconds".format(end-start))
@@ -177,11 +289,7 @@ class TransferFiles():
         start = time.time()
         print("Transferring sync data.")
 
-        session_sync_files = []
-        for file in os.listdir(self.computer_names['sync']):
-            full_path = os.path.join(self.computer_names['sync'], file)
-            if self.get_date_modified(full_path, '%Y-%m-%d') == self.date:
-                session_sync_files.append(full_path)
+        session_sync_files = self.get_source_index('sync').modified_on(self.date)
 
         if self.multiple_experiments==True:
             modified_sync_files_list = []
@@ -190,19 +298,17 @@ class TransferFiles():
                 if sync_timestamp.time() > self.experiment_timestamp:
                     modified_sync_files_list.append(sync_file)
             # self.session_sync_files = sorted(modified_sync_files_list)
-            self.session_sync_files = [(fullpath, datetime.fromtimestamp(os.stat(fullpath).st_ctime)) for fullpath in modified_sync_files_list]
+            self.session_sync_files = [(fullpath, datetime.fromtimestamp(self.get_stat(fullpath).st_ctime)) for fullpath in modified_sync_files_list]
         else:
-            self.session_sync_files = [(fullpath, datetime.fromtimestamp(os.stat(fullpath).st_ctime)) for fullpath in session_sync_files]
+            self.session_sync_files = [(fullpath, datetime.fromtimestamp(self.get_stat(fullpath).st_ctime)) for fullpath in session_sync_files]
             # self.session_sync_files = sorted(session_sync_files)
         self.session_sync_files.sort(key = lambda x: x[1])
 
         for n, name in enumerate(sorted(glob2.glob(os.path.join(self.main_folder, 'recording*')))):
-            if len(glob2.glob(os.path.join(name, "*sync.h5"))) == 0:
-                shutil.copy(self.session_sync_files[n][0], name)
-                old = os.path.join(name, os.path.basename(self.session_sync_files[n][0]))
+            if (self.incremental==True) or (len(glob2.glob(os.path.join(name, "*sync.h5"))) == 0):
                 new = os.path.join(name, os.path.basename(self.session_sync_files[n][0]).split('.')[0] + "_sync.h5")
-                os.rename(old, new)
-                print('sync file transferred to {}'.format(os.path.basename(name)))
+                self.copy_file(self.session_sync_files[n][0], new)
+                print('sync file transferring to {}'.format(os.path.basename(name)))
             else:
                 print('{} already had a sync file'.format(os.path.basename(name)))
 
@@ -217,10 +323,7 @@ class TransferFiles():
         print("Transferring opto data.")
 
         mod_date = datetime.strftime(datetime.strptime(self.date, "%Y-%m-%d"), "%y%m%d")
-        session_opto_files = []
-        for file in os.listdir(self.computer_names['stim']):
-            if mod_date in file:
-                session_opto_files.append(os.path.join(self.computer_names['stim'], file))
+        session_opto_files = self.get_source_index('stim').matching('*{}*'.format(mod_date))
 
         if self.multiple_experiments==True:
             modified_opto_files_list = []
@@ -233,12 +336,10 @@ class TransferFiles():
             self.session_opto_files = sorted(session_opto_files)
 
         for n, name in enumerate(sorted(glob2.glob(os.path.join(self.main_folder, 'recording*')))):
-            if len(glob2.glob(os.path.join(name, "*opto.pkl"))) == 0:
-                shutil.copy(self.session_opto_files[n], name)
-                old = os.path.join(name, os.path.basename(self.session_opto_files[n]))
+            if (self.incremental==True) or (len(glob2.glob(os.path.join(name, "*opto.pkl"))) == 0):
                 new = os.path.join(name, os.path.basename(self.session_opto_files[n].split('_')[0] + "_{}.opto.pkl".format(self.mouse_id)))
-                os.rename(old, new)
-                print('opto file transferred to {}'.format(os.path.basename(name)))
+                self.copy_file(self.session_opto_files[n], new)
+                print('opto file transferring to {}'.format(os.path.basename(name)))
             else:
                 print('{} already had an opto file'.format(os.path.basename(name)))
 
@@ -253,24 +354,20 @@ class TransferFiles():
         print("Transferring videos.")
         mod_date = str(self.date).replace('-', '')
 
-        session_video_files = []
-        for file in os.listdir(self.computer_names['video_eye_beh']):
-            if mod_date in file:
-                session_video_files.append(os.path.join(self.computer_names['video_eye_beh'], file))
+        session_video_files = self.get_source_index('video_eye_beh').matching('*{}*'.format(mod_date))
 
         beh_video_files = sorted([f for f in session_video_files if 'Behavior' in f])
         eye_video_files = sorted([f for f in session_video_files if 'Eye' in f])
 
         for n, name in enumerate(sorted(glob2.glob(os.path.join(self.main_folder, 'recording*')))):
-            if (len(glob2.glob(os.path.join(name, "*Behavior*"))) == 0) | (len(glob2.glob(os.path.join(name, "*Eye*"))) == 0):
+            if (self.incremental==True) | (len(glob2.glob(os.path.join(name, "*Behavior*"))) == 0) | (len(glob2.glob(os.path.join(name, "*Eye*"))) == 0):
                 idx1 = n*2
                 idx2 = idx1+1
                 try:
-                    shutil.copy(beh_video_files[idx1], name)
-                    shutil.copy(beh_video_files[idx2], name)
-                    shutil.copy(eye_video_files[idx1], name)
-                    shutil.copy(eye_video_files[idx2], name)
-                    print("video files transferred to {}.".format(os.path.basename(name)))
+                    video_files = [beh_video_files[idx1], beh_video_files[idx2], eye_video_files[idx1], eye_video_files[idx2]]
+                    for video_file in video_files:
+                        self.copy_file(video_file, os.path.join(name, os.path.basename(video_file)))
+                    print("video files transferring to {}.".format(os.path.basename(name)))
                 except:
                     print("no videos for {}".format(os.path.basename(name)))
                     pass
@@ -283,18 +380,16 @@ class TransferFiles():
     def xfer_brain_imgs(self):
         """
         Tranfer session photos showing brain surface and probe insertion locations.
+        Images that are already in the destination unchanged are skipped.
         """
         start = time.time()
         print("Transferring brain images.")
         mod_date = str(self.date).replace('-', '_')
 
-        session_img_files = []
-        for file in os.listdir(self.computer_names['video_brain_img']):
-            if mod_date in file:
-                session_img_files.append(os.path.join(self.computer_names['video_brain_img'], file))
+        session_img_files = self.get_source_index('video_brain_img').matching('*{}*'.format(mod_date))
 
         for file in session_img_files:
-            shutil.copy(file, self.main_folder)
+            self.copy_file(file, os.path.join(self.main_folder, os.path.basename(file)))
         end = time.time()
         print("That took {} seconds".format(end-start))
 
@@ -305,8 +400,8 @@ class TransferFiles():
         start = time.time()
         print("Transferring params file.")
         try:
-            param_file = glob2.glob(os.path.join(self.computer_names['video_sess_params'], '*{}*'.format(self.date)))[0]
-            shutil.copy(param_file, self.main_folder)
+            param_file = self.get_source_index('video_sess_params').matching('*{}*'.format(self.date))[0]
+            self.copy_file(param_file, os.path.join(self.main_folder, os.path.basename(param_file)))
             end = time.time()
             print("That took {} seconds".format(end-start))
         except:
@@ -6,13 +6,12 @@ import time
 import sys
 import shutil
 import json
+import copy
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
-from np2_ultra.tools import io, file_tools
+from np2_ultra.tools import io, file_tools, kilosort_tools, sync_tools
 import np2_ultra.tools.analysis_tools as ant
-
-from allensdk.brain_observatory.ecephys.align_timestamps import barcode
-from allensdk.brain_observatory.ecephys.align_timestamps import channel_states as cs
-from allensdk.brain_observatory.sync_dataset import Dataset
+import np2_ultra.tools.waveform_tools as wft
 
 class GetWaveforms():
     """
@@ -23,16 +22,22 @@ class GetWaveforms():
     get_directories(recordings = recordings_to_run, probes = probes_to_run)
     waveform_extraction_params(use_json_params=use_json_params)
     run_it()
+    get_recording_state(recording, probes)
+    run_probe(recording, probe)
     get_recording_sync_opto(recording)
     get_recording_and_probe(recording, probe)
     get_all_ks_files(recording, probe)
     get_probe_sync_data(recording, probe)
     get_waveforms(recording, probe)
+    get_cluster_spike_times(cluster_num)
+    bootstrap_clusters_parallel(recording, probe, seed)
+    bootstrap_cluster_batched(data, times_for_cluster, rng=None)
+    bootstrap_cluster_loop(data, times_for_cluster)
     get_opto_data()
     save_data_dicts(recording, probe)
 
     """
-    def __init__(self, date, mouse_id, probes_to_run='all', recordings_to_run='all', use_json_params=None):
+    def __init__(self, date, mouse_id, probes_to_run='all', recordings_to_run='all', use_json_params=None, n_workers=1, n_probe_jobs=1):
         """
         Parameters
         ----------
@@ -46,9 +51,15 @@ class GetWaveforms():
             For if you want to run a subset of the recordings in the session. Pass a list of recording IDs, eg ['recording2', 'recording3']. default runs all
         use_json_params: path
             To specify custom waveform parameters. Pass the location of a JSON file containing a dictionary with the parameters. default is None
+        n_workers: int, optional
+            Number of processes clusters are spread across during waveform extraction. default is 1
+        n_probe_jobs: int, optional
+            Number of recording/probe combos extracted at the same time. default is 1
         """
         self.date = date
         self.mouse_id = mouse_id
+        self.n_workers = n_workers
+        self.n_probe_jobs = n_probe_jobs
         self.computer_names = io.read_computer_names()
         self.pxi_dict = io.read_pxi_dict()
 
@@ -61,21 +72,52 @@ class GetWaveforms():
         Runs waveform extraction and saves dictionaries for recordings and probes specified.
         if __name__ == __main__ automatically calls this function.
         """
-        for recording in self.recording_dirs.keys():
-            self.get_recording_sync_opto(recording)
-
-            for probe in self.probe_data_dirs[recording].keys():
-                skipped_kilosort = self.get_files.get_kilosort_flag(recording, probe)
-                if skipped_kilosort==True:
-                    pass
-                else:
-                    print("--------Starting probe {} for {}--------".format(probe, recording))
-                    self.get_recording_and_probe(recording, probe)
-                    self.get_all_ks_files(recording, probe)
-                    self.get_probe_sync_data(recording, probe)
-                    self.get_waveforms(recording, probe)
-                    self.get_opto_data()
-                    self.save_data_dicts(recording, probe)
+        n_probe_jobs = self.n_probe_jobs
+        if (n_probe_jobs > 1) & (self.extraction_params['extraction_mode'] == 'loop'):
+            print("loop extraction mode uses numpy's global random state, running one probe at a time.")
+            n_probe_jobs = 1
+
+        jobs = []
+        with ThreadPoolExecutor(max_workers=n_probe_jobs) as pool:
+            for recording in self.recording_dirs.keys():
+                probes = [probe for probe in self.probe_data_dirs[recording].keys()
+                            if self.get_files.get_kilosort_flag(recording, probe)==False]
+                recording_state = self.get_recording_state(recording, probes)
+
+                for probe in probes:
+                    jobs.append(pool.submit(recording_state.run_probe, recording, probe))
+            for job in jobs:
+                job.result()
+
+    def get_recording_state(self, recording, probes):
+        """
+        Returns a copy of this instance with the sync and opto data for the recording loaded and the listed probes aligned to sync.
+        The copy is shared read-only by all the probe jobs of the recording.
+        Is run once per recording.
+        """
+        recording_state = copy.copy(self)
+        recording_state.get_recording_sync_opto(recording)
+        recording_state.probe_alignments = sync_tools.get_probe_alignments(self.recording_dirs[recording],
+                                                                            {probe: self.events_dirs[recording][probe] for probe in probes},
+                                                                            recording_state.sync_dataset,
+                                                                            probe_sample_rate=recording_state.probe_sample_rate)
+        return recording_state
+
+    def run_probe(self, recording, probe):
+        """
+        Runs waveform extraction and saves the dictionary for one recording/probe combo.
+        Works on its own copy of the instance so concurrent probe jobs don't overwrite each other's data.
+        Returns the copy, which holds the probe's data_dict.
+        """
+        job = copy.copy(self)
+        print("--------Starting probe {} for {}--------".format(probe, recording))
+        job.get_recording_and_probe(recording, probe)
+        job.get_all_ks_files(recording, probe)
+        job.get_probe_sync_data(recording, probe)
+        job.get_waveforms(recording, probe)
+        job.get_opto_data()
+        job.save_data_dicts(recording, probe)
+        return job
 
     def get_directories(self, recordings, probes):
         """
@@ -97,39 +139,41 @@ class GetWaveforms():
         """
         Sets the waveform extraction parameters for the session. Is initialized in __init__.
         """
+        extraction_params = {
+                            'n_channels': 384,
+                            'tot_waveforms': 200, #total waveforms
+                            'samples_per_spike': 90,
+                            'pre_samples': 30,
+                            'n_boots': 100,
+                            'extraction_mode': 'loop', #'loop', 'batched' (faster, but holds every sampled snippet of a cluster in memory) or 'streaming' (bounded memory)
+                            'boot_batch_size': 10, #bootstraps computed together in batched mode
+                            'stream_chunk_spikes': 256, #unique spikes read and folded in at once in streaming mode
+                            'working_dtype': 'float64', #accumulator precision in streaming mode, 'float64' or 'float32'
+                            'read_gap_samples': 3000, #nearby snippets closer than this are read as one chunk
+                            'read_chunk_samples': 65536, #largest single read from continuous.dat
+                            'channel_radius': None, #microns around each cluster's peak channel to extract in batched mode, None extracts all channels
+                            'peak_spikes': 100, #spikes averaged to find the peak channel when channel_radius is set
+                            'opto_storage': 'dict', #'dict' for nested PSTH dictionaries or 'tensor' for one dense array
+                            'seed': None, #session seed for the per-cluster bootstrap seeds, None draws one from numpy's global state
+                            }
         if use_json_params is not None:
             with open(use_json_params, 'r') as params:
-                extraction_params = json.load(params)
-        else:
-            extraction_params = {
-                                'n_channels': 384,
-                                'tot_waveforms': 200, #total waveforms
-                                'samples_per_spike': 90,
-                                'pre_samples': 30,
-                                'n_boots': 100
-                                }
+                extraction_params.update(json.load(params))
         self.extraction_params = extraction_params
 
     def get_recording_sync_opto(self, recording):
         """
         Gets and unpacks sync and opto timestamp data for the recording being currently processed.
+        Sync edges and barcodes are read from the sync file's cache, see sync_tools.SyncCache.
         Is run once per recording.
         """
         recording_folder = self.recording_dirs[recording]
 
         sync_file = glob2.glob(os.path.join(recording_folder, '*sync.h5'))[0]
-        self.sync_dataset = Dataset(sync_file)
+        self.sync_dataset = sync_tools.SyncCache(sync_file)
         self.probe_sample_rate = 30000.
 
-        barcode_channel = self.sync_dataset._line_to_bit('barcode_ephys')
-        sample_freq_digital = self.sync_dataset.sample_freq
-
-        on_events = self.sync_dataset.get_rising_edges(barcode_channel)
-        off_events = self.sync_dataset.get_falling_edges(barcode_channel)
-        on_times = on_events / sample_freq_digital
-        off_times = off_events / sample_freq_digital
-
-        self.sync_barcode_times, self.sync_barcodes = barcode.extract_barcodes_from_times(on_times, off_times)
+        self.sync_barcode_times, self.sync_barcodes = self.sync_dataset.barcode_times, self.sync_dataset.barcodes
 
         opto_pkl = glob2.glob(os.path.join(recording_folder, '*opto.pkl'))[0]
         self.opto_data = pd.read_pickle(opto_pkl)
@@ -147,25 +191,26 @@ class GetWaveforms():
 
     def get_all_ks_files(self, recording, probe):
         '''
-        Get and read all relevant kilosort files.
+        Get and read all relevant kilosort files. Spike times and clusters are memory-mapped, see kilosort_tools.load_spike_data.
         Is run once per recording/probe combo.
         '''
         data_dir = self.probe_data_dirs[recording][probe]
-        ks_file_dict = {'spike_clusters': 'spike_clusters.npy',
-                        'spike_times': 'spike_times.npy',
-                        'channel_map': 'channel_map.npy',}
+        ks_file_dict = {'channel_map': 'channel_map.npy',}
 
         timestamps_file = os.path.join(self.recording_dirs[recording], 'timestamps.npy')
-        self.recording_timestamp_zero  = np.load(timestamps_file)[0]
-        self.spike_times_opto, self.spike_times_wf= ant.fix_spike_times(os.path.join(data_dir, ks_file_dict['spike_times']),
-                                                                        timestamps_file,
-                                                                        data_dir)
-        self.clusters = np.load(os.path.join(data_dir, ks_file_dict['spike_clusters']))
+        spike_data = kilosort_tools.load_spike_data(data_dir, timestamps_file)
+        self.recording_timestamp_zero = spike_data['t0']
+        self.spike_times_opto = spike_data['spike_times_offset']
+        self.spike_times_wf = spike_data['spike_times']
+        self.clusters = spike_data['spike_clusters']
         self.channel_map = np.squeeze(np.load(os.path.join(data_dir, ks_file_dict['channel_map'])))
+        # only needed to find each cluster's neighborhood
+        self.channel_positions = self.get_files.get_channel_positions(data_dir) if self.extraction_params['channel_radius'] is not None else None
 
         if self.clusters.size > self.spike_times_wf.size:
             print('Cluster assignments outnumber spike times. Taking subset.')
             self.clusters = self.clusters[:self.spike_times_wf.size]
+        self.cluster_index = kilosort_tools.ClusterIndex(self.clusters)
 
         cluster_IDs = pd.read_csv(os.path.join(data_dir,'cluster_KSLabel.tsv'),sep='\t', index_col='cluster_id')
         cluster_assignments = {}
@@ -180,96 +225,188 @@ class GetWaveforms():
         Extract mean waveforms of each cluster ID'd by kilosort and save as dictionary.
         Is run once per recording/probe combo.
         '''
-        data = self.get_files.get_raw_data(recording, probe).T
+        seed = self.extraction_params['seed']
+        if seed is None:
+            seed = int(np.random.randint(2**31))
+        self.session_info['waveform_seed'] = seed
+
+        if (self.n_workers > 1) & (self.extraction_params['extraction_mode'] != 'loop'):
+            cluster_results = self.bootstrap_clusters_parallel(recording, probe, seed)
+        else:
+            data = self.get_files.get_raw_data(recording, probe).T
+            cluster_results = {}
+            for cluster_idx, cluster_num in enumerate(self.good_clusters):
+                print('Analyzing cluster {}, number {} of {}'.format(cluster_num, cluster_idx+1, len(self.good_clusters)))
+
+                times_for_cluster = self.spike_times_wf[self.cluster_index.spike_indices(cluster_num)]
+                if self.extraction_params['extraction_mode'] == 'loop':
+                    np.random.seed(wft.cluster_seed(seed, cluster_num))
+                    cluster_results[cluster_num] = self.bootstrap_cluster_loop(data, times_for_cluster) + (None,)
+                else:
+                    cluster_results[cluster_num] = self.bootstrap_cluster_batched(data, times_for_cluster,
+                                                                                rng=np.random.RandomState(wft.cluster_seed(seed, cluster_num)))
+
         waveforms_dict = {}
-        for cluster_idx, cluster_num in enumerate(self.good_clusters):
-            print('Analyzing cluster {}, number {} of {}'.format(cluster_num, cluster_idx+1, len(self.good_clusters)))
-
-            in_cluster = np.where(self.clusters == cluster_num)[0]
-            times_for_cluster = self.spike_times_wf[in_cluster]
-            waveform_boots = np.zeros((self.extraction_params['n_boots'],
-                                        self.extraction_params['samples_per_spike'],
-                                        self.extraction_params['n_channels']))
-
-            SNR_boots=np.zeros(waveform_boots.shape)
-
-            for i in range(self.extraction_params['n_boots']):
-                times_boot = ant.bootstrap_resample(times_for_cluster, n=self.extraction_params['tot_waveforms'])
-                waveforms = np.zeros((self.extraction_params['samples_per_spike'],
-                                    self.extraction_params['n_channels'],
-                                    self.extraction_params['tot_waveforms']))
-
-                bad_spikes = []
-                for wv_idx in range(0, self.extraction_params['tot_waveforms']):
-                    peak_time = times_boot[wv_idx][0]
-                    raw_waveform = data[int(peak_time-self.extraction_params['pre_samples']):int(peak_time+self.extraction_params['samples_per_spike']-self.extraction_params['pre_samples']),:]
-                    if raw_waveform.shape[0] < self.extraction_params['samples_per_spike']:
-                        bad_spikes.append(wv_idx)
-                        continue
-                    else:
-                        norm_waveform = raw_waveform - np.tile(raw_waveform[0,:],(self.extraction_params['samples_per_spike'],1))
-                        waveforms[:, :, wv_idx] = norm_waveform
-                if len(bad_spikes) > 0:
-                    waveforms = waveforms[:, :, np.setdiff1d(np.arange(self.extraction_params['tot_waveforms']), bad_spikes)]
-                SNR_boots[i,:,:]=ant.signaltonoise(waveforms, axis=2)
-                waveform_boots[i,:,:]=np.mean(waveforms,2)
-
-            waveforms_dict[str(cluster_num)] = {'waveform': np.squeeze(np.mean(waveform_boots,0))[:, self.channel_map],
-                                                'SNR': np.squeeze(np.mean(SNR_boots,0))[:, self.channel_map] }
+        for cluster_num in self.good_clusters:
+            mean_waveform, mean_SNR, channel_rows = cluster_results[cluster_num]
+            if channel_rows is None:
+                waveforms_dict[str(cluster_num)] = {'waveform': np.squeeze(mean_waveform)[:, self.channel_map],
+                                                    'SNR': np.squeeze(mean_SNR)[:, self.channel_map] }
+            else:
+                waveforms_dict[str(cluster_num)] = {'waveform': mean_waveform,
+                                                    'SNR': mean_SNR,
+                                                    'channels': channel_rows}
 
         for n, key in enumerate(waveforms_dict.keys()):
-            k  = int(key)
-            in_cluster = np.where(self.clusters == k)[0]
-            waveforms_dict[str(key)]['spike_times'] = np.squeeze(self.spike_times_wf[in_cluster]) / self.probe_sample_rate - self.probeShift
+            waveforms_dict[str(key)]['spike_times'] = self.get_cluster_spike_times(int(key))
 
         self.waveforms_dict = waveforms_dict
 
+    def get_cluster_spike_times(self, cluster_num):
+        '''
+        Returns the cluster's spike times in seconds on the sync clock.
+        '''
+        in_cluster = self.cluster_index.spike_indices(cluster_num)
+        return np.squeeze(self.spike_times_wf[in_cluster]) / self.probe_sample_rate - self.probeShift
+
+    def bootstrap_clusters_parallel(self, recording, probe, seed):
+        '''
+        Runs the batched bootstrap of every good cluster on a pool of n_workers processes.
+        Each worker opens its own memmap of continuous.dat and gets only its cluster's spike times.
+        Returns a dictionary of (mean_waveform, mean_SNR, channel_rows) keyed by cluster number.
+        '''
+        raw_data_file = self.get_files.get_raw_data_file(recording, probe)
+        with ProcessPoolExecutor(max_workers=self.n_workers) as pool:
+            futures = {}
+            for cluster_num in self.good_clusters:
+                futures[cluster_num] = pool.submit(wft.extract_cluster_waveforms,
+                                                    raw_data_file,
+                                                    np.asarray(self.spike_times_wf[self.cluster_index.spike_indices(cluster_num)]),
+                                                    self.extraction_params,
+                                                    wft.cluster_seed(seed, cluster_num),
+                                                    channel_map=self.channel_map,
+                                                    channel_positions=self.channel_positions)
+            cluster_results = {}
+            for cluster_idx, cluster_num in enumerate(self.good_clusters):
+                cluster_results[cluster_num] = futures[cluster_num].result()
+                print('Analyzed cluster {}, number {} of {}'.format(cluster_num, cluster_idx+1, len(self.good_clusters)))
+        return cluster_results
+
+    def bootstrap_cluster_batched(self, data, times_for_cluster, rng=None):
+        '''
+        Bootstraps the mean waveform and SNR of one cluster from a single read of every spike the bootstraps need.
+        Gives the same result as bootstrap_cluster_loop for the same random seed.
+        If channel_radius is set, only the channels around the cluster's peak channel are extracted and the rows of
+        channel_map they belong to are returned as channel_rows, otherwise channel_rows is None.
+        '''
+        channel_rows = None
+        channels = None
+        if self.extraction_params['channel_radius'] is not None:
+            channel_rows = wft.cluster_channel_rows(data, times_for_cluster, self.extraction_params,
+                                                    self.channel_map, self.channel_positions)
+            channels = self.channel_map[channel_rows]
+        mean_waveform, mean_SNR = wft.bootstrap_cluster(data, times_for_cluster, self.extraction_params, rng=rng, channels=channels)
+        return mean_waveform, mean_SNR, channel_rows
+
+    def bootstrap_cluster_loop(self, data, times_for_cluster):
+        '''
+        Bootstraps the mean waveform and SNR of one cluster one spike at a time.
+        '''
+        waveform_boots = np.zeros((self.extraction_params['n_boots'],
+                                    self.extraction_params['samples_per_spike'],
+                                    self.extraction_params['n_channels']))
+
+        SNR_boots=np.zeros(waveform_boots.shape)
+
+        for i in range(self.extraction_params['n_boots']):
+            times_boot = ant.bootstrap_resample(times_for_cluster, n=self.extraction_params['tot_waveforms'])
+            waveforms = np.zeros((self.extraction_params['samples_per_spike'],
+                                self.extraction_params['n_channels'],
+                                self.extraction_params['tot_waveforms']))
+
+            bad_spikes = []
+            for wv_idx in range(0, self.extraction_params['tot_waveforms']):
+                peak_time = times_boot[wv_idx][0]
+                raw_waveform = data[int(peak_time-self.extraction_params['pre_samples']):int(peak_time+self.extraction_params['samples_per_spike']-self.extraction_params['pre_samples']),:]
+                if raw_waveform.shape[0] < self.extraction_params['samples_per_spike']:
+                    bad_spikes.append(wv_idx)
+                    continue
+                else:
+                    norm_waveform = raw_waveform - np.tile(raw_waveform[0,:],(self.extraction_params['samples_per_spike'],1))
+                    waveforms[:, :, wv_idx] = norm_waveform
+            if len(bad_spikes) > 0:
+                waveforms = waveforms[:, :, np.setdiff1d(np.arange(self.extraction_params['tot_waveforms']), bad_spikes)]
+            SNR_boots[i,:,:]=ant.signaltonoise(waveforms, axis=2)
+            waveform_boots[i,:,:]=np.mean(waveforms,2)
+
+        return np.mean(waveform_boots,0), np.mean(SNR_boots,0)
+
 
     def get_probe_sync_data(self, recording, probe):
         """
-        Gets the probeshift timestamp.
+        Gets the probeshift timestamp and the probe sample rate on the sync clock.
+        Uses the alignment computed for the whole recording in get_recording_state if there is one,
+        otherwise aligns just this probe. Alignments are cached, see sync_tools.get_probe_alignments.
         Is run once per recording/probe combo.
         """
-        # get barcodes from ephys data
-        events_folder = self.events_dirs[recording][probe]
-        channel_states = np.load(os.path.join(events_folder,'channel_states.npy'))
-        event_times = np.load(os.path.join(events_folder,'timestamps.npy'))
-        event_times = event_times - self.recording_timestamp_zero
-        probe_barcode_times, probe_barcodes = cs.extract_barcodes_from_states(channel_states,
-                                                                                event_times, self.probe_sample_rate)
-        # compute time shift between ephys and sync
-        self.probeShift, __, ___ = barcode.get_probe_time_offset(master_times = self.sync_barcode_times,
-                                                        master_barcodes = self.sync_barcodes,
-                                                        probe_times = probe_barcode_times,
-                                                        probe_barcodes = probe_barcodes,
-                                                        acq_start_index = 0,
-                                                        local_probe_rate = self.probe_sample_rate,
-                                                        )
+        if probe not in getattr(self, 'probe_alignments', {}):
+            self.probe_alignments = sync_tools.get_probe_alignments(self.recording_dirs[recording],
+                                                                    {probe: self.events_dirs[recording][probe]},
+                                                                    self.sync_dataset,
+                                                                    probe_sample_rate=self.probe_sample_rate)
+        self.probeShift = self.probe_alignments[probe]['probe_shift']
+        self.probe_rate = self.probe_alignments[probe]['probe_rate']
+        self.session_info['probe_rate'] = self.probe_rate
 
 
     def get_opto_data(self):
         """
         Generates opto PSTHs.
+        Stored as nested dictionaries, or as one dense array if extraction_params['opto_storage'] is 'tensor'.
         Is run once per recording/probe combo.
         """
         pre_time = 0.5
         window_dur = 2
-        opto_response_dict = {}
-        for cond in np.unique(self.opto_data['opto_conditions']):
-            cond_dict = {}
-            for level in np.unique(self.opto_data['opto_levels']):
-                level_dict = {}
-                for cluster in self.good_clusters:
+        conditions = np.unique(self.opto_data['opto_conditions'])
+        levels = np.unique(self.opto_data['opto_levels'])
+        cluster_spike_times = [self.get_cluster_spike_times(cluster) for cluster in self.good_clusters]
+
+        if self.extraction_params['opto_storage'] == 'tensor':
+            # bin times from an empty batch, so they're there even if the recording has no opto conditions or levels
+            _, tp = ant.get_psth_batch([], [], window_dur, binSize=0.01, avg=False)
+            psth_tensor = np.zeros((len(conditions), len(levels), len(self.good_clusters), len(tp)), dtype=np.float32)
+            for c, cond in enumerate(conditions):
+                for l, level in enumerate(levels):
                     opto_trials = (self.opto_data['opto_conditions']==cond) & (self.opto_data['opto_levels']==level)
-                    psth,tp = ant.getPSTH(self.waveforms_dict[str(cluster)]['spike_times'],
-                                        self.opto_on_times[opto_trials]-pre_time,
-                                        window_dur,
-                                        binSize=0.01)
-                    level_dict[cluster] = {'psth': psth, 'times':tp}
-                cond_dict[level] = level_dict
-            cond_key = "stim_{}".format(cond)
-            opto_response_dict[cond_key] = cond_dict
-            opto_response_dict[cond_key]['stim_waveform'] = self.opto_data['opto_waveforms'][cond]
+                    psth_tensor[c, l], _ = ant.get_psth_batch(cluster_spike_times,
+                                                            self.opto_on_times[opto_trials]-pre_time,
+                                                            window_dur,
+                                                            binSize=0.01)
+            opto_response_dict = {'storage': 'tensor',
+                                'psth': psth_tensor,
+                                'conditions': conditions,
+                                'levels': levels,
+                                'clusters': np.array(self.good_clusters),
+                                'times': tp,
+                                'stim_waveforms': [self.opto_data['opto_waveforms'][cond] for cond in conditions]}
+        else:
+            opto_response_dict = {}
+            for cond in conditions:
+                cond_dict = {}
+                for level in levels:
+                    level_dict = {}
+                    opto_trials = (self.opto_data['opto_conditions']==cond) & (self.opto_data['opto_levels']==level)
+                    psths,tp = ant.get_psth_batch(cluster_spike_times,
+                                                self.opto_on_times[opto_trials]-pre_time,
+                                                window_dur,
+                                                binSize=0.01)
+                    for n, cluster in enumerate(self.good_clusters):
+                        level_dict[cluster] = {'psth': psths[n], 'times':tp}
+                    cond_dict[level] = level_dict
+                cond_key = "stim_{}".format(cond)
+                opto_response_dict[cond_key] = cond_dict
+                opto_response_dict[cond_key]['stim_waveform'] = self.opto_data['opto_waveforms'][cond]
+
         opto_response_dict['window_dur'] = window_dur
         opto_response_dict['pre_time'] = pre_time
         self.opto_response_dict = opto_response_dict
@@ -280,13 +417,15 @@ class GetWaveforms():
             extraction_params:
                 parameters used during waveform extraction
             cluster_data
-                mean waveforms
+                mean waveforms. If extracted with channel_radius, waveform and SNR only hold the cluster's neighborhood
+                and 'channels' holds the rows of channel_map they belong to
             session_info:
                 session meta data and parameters
             good_clusters:
                 a list of clusters identified as 'good' by kilosort
             opto_data:
-                PSTHs and opto stim waveforms
+                PSTHs and opto stim waveforms. With opto_storage 'tensor', PSTHs are one (condition, level, cluster, bin)
+                float32 array with coordinate arrays, see analysis_tools.opto_tensor_to_dict for the nested dictionary view
 
         Is run once per recording/probe combo.
         """
@@ -298,8 +437,7 @@ class GetWaveforms():
 
         self.data_dict = save_dict
         save_folder = os.path.join(self.analysis_dir, "probe{}".format(probe))
-        if os.path.exists(save_folder)==False:
-            os.makedirs(save_folder)
+        os.makedirs(save_folder, exist_ok=True)
         pd.to_pickle(save_dict, os.path.join(save_folder, 'extracted_data_{}_probe{}.pkl'.format(recording, probe)))
         print('data dictionary saved in {}'.format(save_folder))
 
@@ -311,8 +449,10 @@ if __name__ == "__main__":
     parser.add_argument('mouse_id', type=str)
     parser.add_argument('--probes_to_run', nargs="+", default='all')
     parser.add_argument('--recordings_to_run', nargs="+", default='all')
-    parser.add_argument('--use_json_params', nargs="+", type=str, default=None)
+    parser.add_argument('--use_json_params', type=str, default=None)
+    parser.add_argument('--n_workers', type=int, default=1)
+    parser.add_argument('--n_probe_jobs', type=int, default=1)
     args = parser.parse_args()
 
-    runner = GetWaveforms(args.date, args.mouse_id, args.probes_to_run, args.recordings_to_run, args.use_json_params)
+    runner = GetWaveforms(args.date, args.mouse_id, args.probes_to_run, args.recordings_to_run, args.use_json_params, args.n_workers, args.n_probe_jobs)
     runner.run_it()
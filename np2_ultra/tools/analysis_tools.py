@@ -78,12 +78,91 @@ def getPSTH(spikes,startTimes,windowDur,binSize=0.01,avg=True):
     t = bins[:-1]
     return counts,t
 
+def get_psth_batch(spike_times_list, startTimes, windowDur, binSize=0.01, avg=True):
+    '''
+    Batched getPSTH for many clusters and trials at once. Trials are cut out of each sorted spike train with searchsorted
+    and binned together with one bincount, giving the same counts as getPSTH.
+
+    Parameters
+    ----------
+    spike_times_list: list of sorted 1D arrays, one per cluster, of spike times in seconds
+    startTimes: 1D array of trial start times in seconds
+    windowDur: float
+        Length of the window after each start time in seconds
+    binSize: float, optional
+        default = 0.01
+    avg: bool, optional
+        Whether to average across trials. default = True
+
+    Returns
+    ----------
+    counts: (cluster, bin) array of firing rates if avg, otherwise (cluster, trial, bin)
+    t: bin start times
+    '''
+    bins = np.arange(0,windowDur+binSize,binSize)
+    n_bins = bins.size-1
+    startTimes = np.asarray(startTimes, dtype=np.float64)
+    n_trials = startTimes.size
+    counts = np.zeros((len(spike_times_list), n_trials, n_bins))
+
+    for c, spikes in enumerate(spike_times_list):
+        spikes = np.atleast_1d(spikes)
+        first = np.searchsorted(spikes, startTimes, side='left')
+        last = np.searchsorted(spikes, startTimes+windowDur, side='right')
+        n_in_trial = last - first
+        if n_in_trial.sum() == 0:
+            continue
+        trial = np.repeat(np.arange(n_trials), n_in_trial)
+        # index of every in-window spike: each trial's run of first[i]..last[i]-1, concatenated
+        spike_idx = np.arange(n_in_trial.sum()) - np.repeat(np.cumsum(n_in_trial)-n_in_trial, n_in_trial) + np.repeat(first, n_in_trial)
+        rel_times = spikes[spike_idx] - startTimes[trial]
+        # same edges as np.histogram: half open bins except the last, which includes its right edge
+        bin_idx = np.searchsorted(bins, rel_times, side='right') - 1
+        bin_idx[rel_times == bins[-1]] = n_bins - 1
+        in_bins = (bin_idx >= 0) & (bin_idx < n_bins)
+        counts[c] = np.bincount(trial[in_bins]*n_bins + bin_idx[in_bins], minlength=n_trials*n_bins).reshape(n_trials, n_bins)
+
+    if avg:
+        counts = counts.mean(axis=1)
+    counts /= binSize
+    t = bins[:-1]
+    return counts,t
+
+def opto_tensor_to_dict(opto_data):
+    '''
+    Presents opto data saved with opto_storage 'tensor' as the nested dictionary written with opto_storage 'dict':
+    opto_data["stim_<condition>"][level][cluster] = {'psth': psth, 'times': times}, plus 'stim_waveform' per condition
+    and the top level 'window_dur' and 'pre_time'. Dictionaries already in the nested format are returned unchanged.
+
+    Parameters
+    ----------
+    opto_data: the 'opto_data' entry of an extracted data dictionary
+
+    Returns
+    ----------
+    opto_response_dict: nested dictionary of PSTHs
+    '''
+    if opto_data.get('storage') != 'tensor':
+        return opto_data
+
+    opto_response_dict = {}
+    for c, cond in enumerate(opto_data['conditions']):
+        cond_dict = {}
+        for l, level in enumerate(opto_data['levels']):
+            cond_dict[level] = {int(cluster): {'psth': opto_data['psth'][c, l, n], 'times': opto_data['times']}
+                                for n, cluster in enumerate(opto_data['clusters'])}
+        cond_dict['stim_waveform'] = opto_data['stim_waveforms'][c]
+        opto_response_dict["stim_{}".format(cond)] = cond_dict
+    opto_response_dict['window_dur'] = opto_data['window_dur']
+    opto_response_dict['pre_time'] = opto_data['pre_time']
+    return opto_response_dict
+
 def get_sync_line_data(syncDataset, line_label=None, channel=None):
     ''' Get rising and falling edge times for a particular line from the sync h5 file
 
         Parameters
         ----------
-        dataset: sync file dataset generated by sync.Dataset
+        dataset: sync file dataset generated by sync.Dataset, or a sync_tools.SyncCache to skip reading the h5 file
         line_label: string specifying which line to read, if that line was labelled during acquisition
         channel: integer specifying which channel to read in line wasn't labelled
 
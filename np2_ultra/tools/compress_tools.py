@@ -0,0 +1,385 @@
+import os
+import json
+import zlib
+import struct
+import time
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+COMPRESSED_NAME = 'continuous.cdat'
+MAGIC = b'NP2CDAT1'
+FOOTER = struct.Struct('<QQ')
+JOURNAL_INTERVAL = 10.
+
+
+def compressed_path(dat_file):
+    """Path of the compressed version of a continuous.dat file."""
+    return os.path.join(os.path.dirname(dat_file), COMPRESSED_NAME)
+
+def encode_chunk(chunk, level=6):
+    """
+    Losslessly compresses a (samples, channels) int16 chunk.
+    Each channel is stored as its first sample followed by the sample to sample differences (int16 arithmetic wraps,
+    so this is exact), the high and low bytes are split into separate planes, and the result is zlib compressed.
+    """
+    delta = np.empty_like(chunk)
+    delta[0] = chunk[0]
+    np.subtract(chunk[1:], chunk[:-1], out=delta[1:])
+    planes = np.ascontiguousarray(delta.view(np.uint8).reshape(-1, 2).T)
+    return zlib.compress(planes.tobytes(), level)
+
+def decode_chunk(payload, n_samples, n_channels):
+    """Inverse of encode_chunk. Returns a (n_samples, n_channels) int16 array."""
+    planes = np.frombuffer(zlib.decompress(payload), dtype=np.uint8).reshape(2, -1)
+    delta = np.ascontiguousarray(planes.T).view(np.int16).reshape(n_samples, n_channels)
+    return np.cumsum(delta, axis=0, dtype=np.int16)
+
+def read_compress_journal(out_file, src_stat, params):
+    """
+    Returns the journal an interrupted compress_dat to out_file can resume from, or None if there's no usable journal
+    for the current version of the source and the same settings (params). The journaled part of the partial file is
+    read back and its checksum compared with the journal's before it's trusted.
+    """
+    partial_file = out_file + '.partial'
+    journal_file = partial_file + '.json'
+    if (os.path.exists(journal_file)==False) or (os.path.exists(partial_file)==False):
+        return None
+    try:
+        with open(journal_file, 'r') as f:
+            journal = json.load(f)
+        if (journal['size'] != src_stat.st_size) or (journal['mtime'] != src_stat.st_mtime):
+            return None
+        if any([journal[key] != value for key, value in params.items()]) or (os.path.getsize(partial_file) < journal['position']):
+            return None
+        crc = 0
+        remaining = journal['position']
+        with open(partial_file, 'rb') as f:
+            while remaining > 0:
+                block = f.read(min(remaining, 16*1024**2))
+                crc = zlib.crc32(block, crc)
+                remaining -= len(block)
+        if crc == journal['stored_crc32']:
+            return journal
+        print("{} doesn't match its journal, compressing it again".format(partial_file))
+    except (ValueError, KeyError):
+        pass
+    return None
+
+def compress_dat(dat_file, out_files=None, n_channels=384, chunk_samples=30000, level=3, n_threads=4):
+    """
+    Writes a chunked, losslessly compressed copy of a continuous.dat file that CompressedDat can read at random.
+    The file is read once; chunks are compressed on n_threads threads and written to every file in out_files.
+
+    The compressed file is the MAGIC string, the compressed chunks, a table of the byte offset of every chunk,
+    a json header and a footer holding the header length and the position of the offset table. Bytes after the last
+    whole sample (a file that was cut off) are kept in the header so decompress_dat gives back the exact file.
+    Each output is written to out_file.partial and renamed once it's complete. Every JOURNAL_INTERVAL seconds the
+    partial files are flushed to disk and the chunks written so far are recorded in out_file.partial.json, so an
+    interrupted compression resumes after the last journaled chunk if the source and settings haven't changed.
+
+    Parameters
+    ----------
+    dat_file: path
+        Raw int16 continuous.dat
+    out_files: path or list of paths, optional
+        default None writes continuous.cdat next to dat_file
+    n_channels: int, optional
+        default = 384
+    chunk_samples: int, optional
+        Samples per compressed chunk, the smallest unit that is decompressed on a read. default = 30000 (1s at 30kHz)
+    level: int, optional
+        zlib compression level. default = 3
+    n_threads: int, optional
+        default = 4
+
+    Returns
+    ----------
+    info: dict of 'size' (raw bytes), 'stored_size' (compressed bytes) and 'crc32' of the raw data
+    """
+    if out_files is None:
+        out_files = [compressed_path(dat_file)]
+    elif isinstance(out_files, (list, tuple))==False:
+        out_files = [out_files]
+    src_stat = os.stat(dat_file)
+    raw_size = src_stat.st_size
+    n_samples = raw_size // (2*n_channels)
+    tail = b''
+    chunk_bytes = chunk_samples*n_channels*2
+    params = {'n_channels': n_channels, 'chunk_samples': chunk_samples, 'level': level}
+
+    for out_file in out_files:
+        os.makedirs(os.path.dirname(out_file), exist_ok=True)
+    # the outputs are written in step, so they're only resumed if every one stopped at the same journaled chunk
+    journals = [read_compress_journal(out_file, src_stat, params) for out_file in out_files]
+    if any([journal is None for journal in journals]) or (len(set([(j['raw_offset'], j['position'], j['stored_crc32']) for j in journals])) != 1):
+        fouts = [open(out_file + '.partial', 'wb') for out_file in out_files]
+        offsets = []
+        crc = 0
+        raw_offset = 0
+        position = len(MAGIC)
+        stored_crc = zlib.crc32(MAGIC)
+        for fout in fouts:
+            fout.write(MAGIC)
+    else:
+        journal = journals[0]
+        print("resuming compression of {} from byte {}".format(dat_file, journal['raw_offset']))
+        fouts = [open(out_file + '.partial', 'r+b') for out_file in out_files]
+        offsets = list(journal['offsets'])
+        crc = journal['crc32']
+        raw_offset = journal['raw_offset']
+        position = journal['position']
+        stored_crc = journal['stored_crc32']
+        for fout in fouts:
+            fout.truncate(position)
+            fout.seek(position)
+    last_journal = time.time()
+    try:
+        with open(dat_file, 'rb') as fsrc, ThreadPoolExecutor(max_workers=n_threads) as pool:
+            fsrc.seek(raw_offset)
+            pending = []
+            read_offset = raw_offset
+            raw = fsrc.read(chunk_bytes)
+            while (len(raw) > 0) or (len(pending) > 0):
+                while (len(raw) > 0) and (len(pending) < 2*n_threads):
+                    # a file cut off mid-sample keeps its last few bytes as they are, added to the checksum at the end
+                    n_whole = len(raw) - len(raw) % (2*n_channels)
+                    tail = raw[n_whole:]
+                    if n_whole > 0:
+                        crc = zlib.crc32(memoryview(raw)[:n_whole], crc)
+                        read_offset += n_whole
+                        chunk = np.frombuffer(raw, dtype=np.int16, count=n_whole//2).reshape(-1, n_channels)
+                        pending.append((pool.submit(encode_chunk, chunk, level), read_offset, crc))
+                    raw = fsrc.read(chunk_bytes)
+                if len(pending) == 0:
+                    break
+                future, raw_offset, chunk_crc = pending.pop(0)
+                payload = future.result()
+                offsets.append(position)
+                position += len(payload)
+                stored_crc = zlib.crc32(payload, stored_crc)
+                for fout in fouts:
+                    fout.write(payload)
+                if time.time() - last_journal >= JOURNAL_INTERVAL:
+                    journal = dict(params, size=src_stat.st_size, mtime=src_stat.st_mtime, raw_offset=raw_offset, crc32=chunk_crc,
+                                    offsets=offsets, position=position, stored_crc32=stored_crc)
+                    for fout, out_file in zip(fouts, out_files):
+                        fout.flush()
+                        os.fsync(fout.fileno())
+                        with open(out_file + '.partial.json.tmp', 'w') as f:
+                            json.dump(journal, f)
+                        os.replace(out_file + '.partial.json.tmp', out_file + '.partial.json')
+                    last_journal = time.time()
+        offsets.append(position)
+        crc = zlib.crc32(tail, crc)
+
+        header = json.dumps({'n_channels': n_channels,
+                             'n_samples': n_samples,
+                             'chunk_samples': chunk_samples,
+                             'dtype': 'int16',
+                             'codec': 'delta-byteplane-zlib',
+                             'tail': tail.hex(),
+                             'crc32': crc}).encode()
+        table = np.asarray(offsets, dtype='<u8').tobytes()
+        for fout in fouts:
+            fout.write(table)
+            fout.write(header)
+            fout.write(FOOTER.pack(len(header), position))
+    finally:
+        for fout in fouts:
+            fout.close()
+
+    for out_file in out_files:
+        os.replace(out_file + '.partial', out_file)
+        if os.path.exists(out_file + '.partial.json'):
+            os.remove(out_file + '.partial.json')
+    return {'size': raw_size, 'stored_size': os.path.getsize(out_files[0]), 'crc32': crc}
+
+def decompress_dat(compressed_file, dat_file=None, n_threads=4):
+    """
+    Writes the raw continuous.dat back out from a compressed file, through dat_file.partial.
+    default dat_file None writes continuous.dat next to the compressed file.
+    Raises IOError if the result doesn't match the checksum of the original data.
+    """
+    if dat_file is None:
+        dat_file = os.path.join(os.path.dirname(compressed_file), 'continuous.dat')
+    data = CompressedDat(compressed_file, cache_chunks=0)
+    crc = 0
+    with open(dat_file + '.partial', 'wb') as fout, ThreadPoolExecutor(max_workers=n_threads) as pool:
+        for chunk in pool.map(data.read_chunk, range(data.n_chunks)):
+            raw = chunk.tobytes()
+            crc = zlib.crc32(raw, crc)
+            fout.write(raw)
+        tail = bytes.fromhex(data.header['tail'])
+        crc = zlib.crc32(tail, crc)
+        fout.write(tail)
+    if crc != data.header['crc32']:
+        os.remove(dat_file + '.partial')
+        raise IOError("decompressed data from {} doesn't match its checksum".format(compressed_file))
+    os.replace(dat_file + '.partial', dat_file)
+    return dat_file
+
+def data_crc32(compressed_file):
+    """CRC32 checksum of the raw data stored in a compressed file, for comparing against the original continuous.dat."""
+    data = CompressedDat(compressed_file, cache_chunks=0)
+    crc = 0
+    for chunk_num in range(data.n_chunks):
+        crc = zlib.crc32(data.read_chunk(chunk_num).tobytes(), crc)
+    return zlib.crc32(bytes.fromhex(data.header['tail']), crc)
+
+def open_continuous(raw_data_file, n_channels=384):
+    """
+    Opens continuous data as a read-only (samples, channels) array: a memmap of a continuous.dat file or a
+    CompressedDat of a compressed one.
+    """
+    if raw_data_file.endswith(COMPRESSED_NAME):
+        return CompressedDat(raw_data_file)
+    raw_data = np.memmap(raw_data_file, dtype='int16', mode='r')
+    return np.reshape(raw_data, (int(raw_data.size/n_channels), n_channels))
+
+
+class CompressedDat():
+    """
+    Read-only (samples, channels) view of a compressed continuous.dat that can be sliced like the memmap it replaces.
+    Only the chunks a read touches are decompressed, and the most recently used chunks are kept in memory.
+
+    Methods
+    ----------
+    read_chunk(chunk_num)
+    read(start, stop)
+    """
+    ndim = 2
+
+    def __init__(self, compressed_file, cache_chunks=8):
+        """
+        Parameters
+        ----------
+        compressed_file: path
+            File written by compress_dat
+        cache_chunks: int, optional
+            Number of decompressed chunks kept in memory. default = 8
+        """
+        self.compressed_file = compressed_file
+        self.cache_chunks = cache_chunks
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+        with open(compressed_file, 'rb') as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise IOError("{} isn't a compressed continuous.dat".format(compressed_file))
+            f.seek(-FOOTER.size, os.SEEK_END)
+            header_size, table_pos = FOOTER.unpack(f.read(FOOTER.size))
+            f.seek(-FOOTER.size-header_size, os.SEEK_END)
+            self.header = json.loads(f.read(header_size))
+            f.seek(table_pos)
+            n_chunks = -(-self.header['n_samples'] // self.header['chunk_samples'])
+            self.offsets = np.frombuffer(f.read(8*(n_chunks+1)), dtype='<u8').astype(np.int64)
+        self.n_chunks = n_chunks
+        self.chunk_samples = self.header['chunk_samples']
+        self.shape = (self.header['n_samples'], self.header['n_channels'])
+        self.dtype = np.dtype(self.header['dtype'])
+        self.size = self.shape[0]*self.shape[1]
+
+    def __len__(self):
+        return self.shape[0]
+
+    @property
+    def T(self):
+        return TransposedCompressedDat(self)
+
+    def read_chunk(self, chunk_num):
+        """Decompresses one chunk as a (samples, channels) array."""
+        with self.lock:
+            if chunk_num in self.cache:
+                self.cache.move_to_end(chunk_num)
+                return self.cache[chunk_num]
+        with open(self.compressed_file, 'rb') as f:
+            f.seek(self.offsets[chunk_num])
+            payload = f.read(self.offsets[chunk_num+1] - self.offsets[chunk_num])
+        n_samples = min(self.chunk_samples, self.shape[0] - chunk_num*self.chunk_samples)
+        chunk = decode_chunk(payload, n_samples, self.shape[1])
+        chunk.flags.writeable = False
+        if self.cache_chunks > 0:
+            with self.lock:
+                self.cache[chunk_num] = chunk
+                while len(self.cache) > self.cache_chunks:
+                    self.cache.popitem(last=False)
+        return chunk
+
+    def read(self, start, stop):
+        """Returns samples start to stop (all channels) as a new array."""
+        start = max(0, min(start, self.shape[0]))
+        stop = max(start, min(stop, self.shape[0]))
+        out = np.empty((stop-start, self.shape[1]), dtype=self.dtype)
+        for chunk_num in range(start // self.chunk_samples, -(-stop // self.chunk_samples)):
+            chunk_start = chunk_num*self.chunk_samples
+            lo = max(start, chunk_start)
+            hi = min(stop, chunk_start + self.chunk_samples)
+            out[lo-start:hi-start] = self.read_chunk(chunk_num)[lo-chunk_start:hi-chunk_start]
+        return out
+
+    def __getitem__(self, key):
+        if isinstance(key, tuple):
+            rows = key[0]
+            cols = key[1:]
+        else:
+            rows = key
+            cols = ()
+        if isinstance(rows, slice):
+            start, stop, step = rows.indices(self.shape[0])
+            if step > 0:
+                out = self.read(start, stop)[::step]
+            else:
+                out = self.read(stop+1, start+1)[::-1][::-step]
+        elif np.isscalar(rows) and (np.ndim(rows) == 0) and (isinstance(rows, (bool, np.bool_))==False):
+            row = int(rows)
+            if row < 0:
+                row += self.shape[0]
+            if (row < 0) or (row >= self.shape[0]):
+                raise IndexError("index {} is out of bounds for axis 0 with size {}".format(rows, self.shape[0]))
+            out = self.read(row, row+1)[0]
+        else:
+            rows = np.arange(self.shape[0])[rows]
+            if rows.size == 0:
+                out = np.empty((0, self.shape[1]), dtype=self.dtype)
+            else:
+                lo = int(rows.min())
+                out = self.read(lo, int(rows.max())+1)[rows-lo]
+        if len(cols) > 0:
+            out = out[cols] if out.ndim == 1 else out[(slice(None),) + cols]
+        return out
+
+    def __array__(self, dtype=None, copy=None):
+        out = self.read(0, self.shape[0])
+        if dtype is not None:
+            out = out.astype(dtype)
+        return out
+
+
+class TransposedCompressedDat():
+    """(channels, samples) view of a CompressedDat, the layout GetFiles.get_raw_data returns."""
+    ndim = 2
+
+    def __init__(self, data):
+        self.data = data
+        self.shape = data.shape[::-1]
+        self.dtype = data.dtype
+        self.size = data.size
+
+    def __len__(self):
+        return self.shape[0]
+
+    @property
+    def T(self):
+        return self.data
+
+    def __getitem__(self, key):
+        if isinstance(key, tuple)==False:
+            key = (key,)
+        key = key + (slice(None),)*(2-len(key))
+        out = self.data[key[1], key[0]]
+        return out.T
+
+    def __array__(self, dtype=None, copy=None):
+        return np.asarray(self.data, dtype=dtype).T
@@ -4,8 +4,12 @@ import numpy as np
 import json
 import time
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 
-from np2_ultra.tools import io, file_tools
+from np2_ultra.tools import io, file_tools, kilosort_tools, db_tools
+import np2_ultra.tools.compress_tools as ct
+
+INDEX_NAME = 'session_status.sqlite'
 
 
 class SessionSummary():
@@ -43,87 +47,159 @@ class SessionSummary():
         else:
             return df
 
-    def generate_session_df(self):
-        sessions = os.listdir(self.data_dir)
-        check_df = pd.DataFrame(columns=self.columns)
-
-        n=0
-        for session in sessions:
-            session_path = os.path.join(self.data_dir, session)
-            analysis_path = os.path.join(self.analysis_dir, session)
-
-            try:
-                params_file = os.path.join(session_path, "{}_sess_params.json".format(session))
-                with open(params_file, 'r') as p:
-                    params = json.load(p)
-                    genotype = params['genotype'].lower()
-            except:
-                if "saline" in session:
-                    genotype = "saline"
-                else:
-                    genotype = "none"
-
-            recordings = [d for d in os.listdir(session_path) if "recording" in d]
-            for recording in recordings:
-                recording_dir = os.path.join(session_path, recording, 'continuous')
-
-                objects = []
-                for root, dirs, files in os.walk(recording_dir):
-                    objects.append((root, dirs, files))
-
-                npx_folders = os.listdir(recording_dir)
-                if len(npx_folders) < 6:
-                    print("something is missing in {} {}. Maybe it's still transferring?".format(session, recording))
-                    break
-
-
-                for key in self.pxi_dict['reverse'].keys():
-                    for folder in npx_folders:
-                        if key in folder:
-                            probe_session_files = [t for t in objects if folder in t[0]][0][2]
-                            dat_file = "continuous.dat" in probe_session_files
-                            mat_file = "rez.mat" in probe_session_files
-                            flags_file = "flags.json" in probe_session_files
-                            probe_letter = self.pxi_dict['reverse'][key]
-                            try:
-                                analysis_loc = os.listdir(os.path.join(analysis_path, "probe{}".format(probe_letter)))
-                                analysis_file = [f for f in analysis_loc if "{}_probe".format(recording) in f]
-                                try:
-                                    analysis_file_loc = os.path.join(analysis_path, "probe{}".format(probe_letter), analysis_file[0])
-                                except IndexError:
-                                    analysis_file_loc = ''
-                            except FileNotFoundError:
-                                analysis_file = []
-                                analysis_file_loc = ''
+    def get_index(self):
+        if 'index' not in dir(self):
+            self.index = SessionIndex(io.get_local_state_file(INDEX_NAME, self.computer_names), self.columns + ["data_folder", "analysis_file"])
+        return self.index
+
+    def mtime(self, path):
+        """modified time of path, or None if it doesn't exist"""
+        try:
+            return os.stat(path).st_mtime
+        except OSError:
+            return None
+
+    def generate_session_df(self, rebuild=False, n_threads=8):
+        """refreshes the session status index and loads it as df.
+        only sessions where one of the folders (or flags or params files) seen on the last scan has a new modified time, new sessions
+        and sessions that were still incomplete are scanned again; the rest come straight from the index.
+        sessions are checked and scanned on n_threads threads, so the round trips to the data drive overlap.
+        rebuild: bool, scan every session again
+        n_threads: int, number of sessions checked or scanned at once"""
+        index = self.get_index()
+        sessions = [entry.name for entry in os.scandir(self.data_dir) if entry.is_dir()]
+        scanned = index.get_scanned()
 
-                            check_df.at[n, 'session'] = session
-                            check_df.at[n, 'recording'] = recording
-                            check_df.at[n, 'probe'] = probe_letter
-                            check_df.at[n, 'dat_file'] = int(dat_file)
-                            check_df.at[n, 'rez.mat'] = int(mat_file)
-                            check_df.at[n, 'analysis_pkl'] = len(analysis_file)
-                            check_df.at[n, 'genotype'] = genotype
-                            check_df.at[n, 'data_folder'] = [t for t in objects if folder in t[0]][0][0]
-                            check_df.at[n, 'analysis_file'] = analysis_file_loc
-
-                            if flags_file==True:
-                                flags_loc = os.path.join([t for t in objects if folder in t[0]][0][0], 'flags.json')
-                                with open(flags_loc, 'r') as f:
-                                    flags = json.load(f)
-                                    try:
-                                        check_df.at[n, 'flags'] = flags['other_notes']
-                                    except KeyError:
-                                        check_df.at[n, 'flags'] = 'generic flag'
-
-                            else:
-                                check_df.at[n, 'flags'] = " "
-
-                            n += 1
-
-        self.df = check_df
+        def needs_scan(session):
+            if (rebuild==True) or (session not in scanned) or (scanned[session]['complete']==False):
+                return True
+            return any(self.mtime(path) != mtime for path, mtime in scanned[session]['mtimes'].items())
+
+        with ThreadPoolExecutor(max_workers=n_threads) as pool:
+            to_scan = [session for session, changed in zip(sessions, pool.map(needs_scan, sessions)) if changed==True]
+            # results come back in session order and are written from this thread
+            for session, (rows, mtimes, complete) in zip(to_scan, pool.map(self.scan_session, to_scan)):
+                index.replace_session(session, rows, mtimes, complete)
+        index.remove_sessions([session for session in scanned if session not in sessions])
+        print("scanned {} of {} sessions".format(len(to_scan), len(sessions)))
+
+        # rows in the order the sessions are listed in the data folder, like a walk of the folders
+        order = {session: n for n, session in enumerate(sessions)}
+        df = index.get_df()
+        self.df = df.iloc[np.argsort(df['session'].map(order).values, kind='stable')].reset_index(drop=True)
         if self.save==True:
             self.save_csv()
 
+    def list_dir(self, path):
+        """{name: os.DirEntry} of the items in a folder, or None if it doesn't exist.
+        on Windows the entries already hold the items' modified times, so they don't cost another trip to the drive"""
+        try:
+            with os.scandir(path) as entries:
+                return {entry.name: entry for entry in entries}
+        except FileNotFoundError:
+            return None
+
+    def entry_mtime(self, entries, name):
+        """modified time of an item from its folder's list_dir, or None if it isn't there"""
+        if (entries is None) or (name not in entries):
+            return None
+        return entries[name].stat().st_mtime
+
+    def scan_session(self, session):
+        """lists the data and analysis folders of one session.
+        returns the session's rows, the modified time of every folder and flags file that was looked at (taken before
+        it was read, so changes made during the scan are picked up on the next refresh) and whether the session was complete"""
+        session_path = os.path.join(self.data_dir, session)
+        analysis_path = os.path.join(self.analysis_dir, session)
+        mtimes = {session_path: self.mtime(session_path), analysis_path: self.mtime(analysis_path)}
+        rows = []
+        complete = True
+
+        try:
+            params_file = os.path.join(session_path, "{}_sess_params.json".format(session))
+            # the genotype comes from the params file, so it's checked too
+            mtimes[params_file] = self.mtime(params_file)
+            with open(params_file, 'r') as p:
+                params = json.load(p)
+                genotype = params['genotype'].lower()
+        except:
+            if "saline" in session:
+                genotype = "saline"
+            else:
+                genotype = "none"
+
+        session_entries = self.list_dir(session_path)
+        if session_entries is None:
+            # removed since the data folder was listed, it's dropped from the index on the next refresh
+            return rows, mtimes, False
+        analysis_entries = self.list_dir(analysis_path)
+        analysis_files = {}
+
+        recordings = [d for d in session_entries if "recording" in d]
+        for recording in recordings:
+            recording_dir = os.path.join(session_path, recording, 'continuous')
+            mtimes[os.path.join(session_path, recording)] = self.entry_mtime(session_entries, recording)
+            mtimes[recording_dir] = self.mtime(recording_dir)
+
+            npx_entries = self.list_dir(recording_dir)
+            if npx_entries is None:
+                raise FileNotFoundError("no continuous folder in {}".format(os.path.join(session_path, recording)))
+            npx_folders = list(npx_entries.keys())
+            if len(npx_folders) < 6:
+                print("something is missing in {} {}. Maybe it's still transferring?".format(session, recording))
+                complete = False
+                break
+
+            for key in self.pxi_dict['reverse'].keys():
+                for folder in npx_folders:
+                    if key in folder:
+                        data_folder = os.path.join(recording_dir, folder)
+                        mtimes[data_folder] = self.entry_mtime(npx_entries, folder)
+                        probe_entries = self.list_dir(data_folder)
+                        dat_file = ("continuous.dat" in probe_entries) or (ct.COMPRESSED_NAME in probe_entries)
+                        mat_file = "rez.mat" in probe_entries
+                        flags_file = "flags.json" in probe_entries
+                        probe_letter = self.pxi_dict['reverse'][key]
+
+                        analysis_probe_name = "probe{}".format(probe_letter)
+                        analysis_probe_dir = os.path.join(analysis_path, analysis_probe_name)
+                        mtimes[analysis_probe_dir] = self.entry_mtime(analysis_entries, analysis_probe_name)
+                        if analysis_probe_name not in analysis_files:
+                            analysis_files[analysis_probe_name] = self.list_dir(analysis_probe_dir) if analysis_entries is not None else None
+                        analysis_loc = analysis_files[analysis_probe_name]
+                        if analysis_loc is not None:
+                            analysis_file = [f for f in analysis_loc if "{}_probe".format(recording) in f]
+                            try:
+                                analysis_file_loc = os.path.join(analysis_probe_dir, analysis_file[0])
+                            except IndexError:
+                                analysis_file_loc = ''
+                        else:
+                            analysis_file = []
+                            analysis_file_loc = ''
+
+                        if flags_file==True:
+                            # rewriting flags.json doesn't change its folder's modified time, so the file is checked too
+                            flags_loc = os.path.join(data_folder, 'flags.json')
+                            mtimes[flags_loc] = self.entry_mtime(probe_entries, 'flags.json')
+                            with open(flags_loc, 'r') as f:
+                                flags = json.load(f)
+                            flag_text = flags.get('other_notes', 'generic flag')
+                        else:
+                            flag_text = " "
+
+                        rows.append({'session': session,
+                                     'recording': recording,
+                                     'probe': probe_letter,
+                                     'dat_file': int(dat_file),
+                                     'rez.mat': int(mat_file),
+                                     'analysis_pkl': len(analysis_file),
+                                     'flags': flag_text,
+                                     'genotype': genotype,
+                                     'data_folder': data_folder,
+                                     'analysis_file': analysis_file_loc})
+
+        return rows, mtimes, complete
+
     def save_csv(self):
         fname = 'np2_session_status_{}.csv'.format(datetime.strftime(datetime.today(), '%Y-%m-%d_%H%M'))
         save_path = os.path.join(self.file_dir, fname)
@@ -131,7 +207,20 @@ class SessionSummary():
         self.df.to_csv(save_path)
         print('saved at {}'.format(save_path))
 
+    def use_index(self):
+        """True if the session status index has been built, in which case queries run on it instead of a saved csv"""
+        if os.path.exists(io.get_local_state_file(INDEX_NAME, self.computer_names))==False:
+            return False
+        return self.get_index().n_rows() > 0
+
     def get_data_cube(self):
+        if self.use_index()==True:
+            datacube = self.get_index().query("""SELECT genotype, COUNT(DISTINCT session) AS n_sessions FROM probes
+                                                 WHERE genotype!='saline' GROUP BY genotype ORDER BY genotype""")
+            datacube.set_index('genotype', inplace=True)
+            self.datacube = datacube
+            return datacube
+
         if 'df' not in dir(self):
             self.df, fn = self.get_most_recent(return_filename=True)
             print("using most recently saved session summary found here:")
@@ -145,6 +234,19 @@ class SessionSummary():
         return datacube
 
     def get_unprocessed_sessions(self, kilosort=True, analysis_pkl=True):
+        if self.use_index()==True:
+            conditions = []
+            if kilosort==True:
+                conditions.append('"rez.mat"=0')
+            if analysis_pkl==True:
+                conditions.append('analysis_pkl=0')
+            if len(conditions) == 0:
+                # nothing to look for, no rows match
+                conditions.append('0')
+            unprocessed = self.get_index().get_df("flags=' ' AND genotype!='saline' AND ({})".format(" OR ".join(conditions)))
+            self.unprocessed = unprocessed
+            return unprocessed
+
         if 'df' not in dir(self):
             self.df, fn = self.get_most_recent(return_filename=True)
             print("using most recently saved session summary found here:")
@@ -156,7 +258,9 @@ class SessionSummary():
         if analysis_pkl==True:
             rows.append(self.df[(self.df['analysis_pkl']==0)&(self.df.flags==' ')&(self.df.genotype!='saline')])
 
-        if (kilosort==True) & (analysis_pkl==True):
+        if len(rows) == 0:
+            unprocessed = self.df.iloc[:0]
+        elif (kilosort==True) & (analysis_pkl==True):
             unprocessed = pd.concat(rows)
             unprocessed.reset_index(inplace=True)
             unprocessed.drop(index=unprocessed[unprocessed.duplicated(keep='first')==True].index, inplace=True)
@@ -167,5 +271,101 @@ class SessionSummary():
         self.unprocessed = unprocessed
         return unprocessed
 
+    def get_kilosort_queue(self, session=None):
+        """gets the jobs in the kilosort queue (of one session, eg '2021-06-01_123456', if given) as a df,
+        with their state, attempts, duration and last error. The number of jobs in each state is available as kilosort_queue_counts.
+        The queue is kept on the sorting computer's own disk, so this only shows it when run on that computer."""
+        queue = kilosort_tools.KilosortQueue(io.get_local_state_file("kilosort_queue.sqlite", self.computer_names))
+        columns = ["session", "recording", "probe", "state", "priority", "attempts", "max_attempts", "duration", "error", "host", "probe_dir"]
+        self.kilosort_queue = pd.DataFrame(queue.jobs(session), columns=columns)
+        self.kilosort_queue_counts = queue.counts(session)
+        return self.kilosort_queue
+
+
+class SessionIndex():
+    """
+    SQLite index of the processing status of every session/recording/probe, the rows of SessionSummary.df, kept with the
+    modified times of the folders each session's rows were read from so SessionSummary only scans sessions that changed.
+    It's a cache of the scans kept on each computer's own disk (see io.get_local_state_file), not on dest_root.
+
+    Methods
+    ----------
+    get_scanned()
+    replace_session(session, rows, mtimes, complete)
+    remove_sessions(sessions)
+    get_df(where=None)
+    query(sql, values=())
+    n_rows()
+    """
+    def __init__(self, db_file, columns):
+        """
+        Parameters
+        ----------
+        db_file: path
+            SQLite file of the index, created if it doesn't exist
+        columns: list of str
+            Columns of a row, starting with session, recording and probe
+        """
+        self.db_file = db_file
+        self.columns = columns
+        column_defs = ", ".join(['"{}"'.format(c) for c in columns])
+        with self.connect() as db:
+            db.execute("CREATE TABLE IF NOT EXISTS probes ({}, position INTEGER, PRIMARY KEY (session, recording, probe))".format(column_defs))
+            db.execute("CREATE TABLE IF NOT EXISTS sessions (session TEXT PRIMARY KEY, complete INTEGER, scanned_at REAL)")
+            db.execute("CREATE TABLE IF NOT EXISTS mtimes (session TEXT, path TEXT, mtime REAL, PRIMARY KEY (session, path))")
+            db.execute("CREATE INDEX IF NOT EXISTS probes_genotype ON probes (genotype, session)")
+            db.execute('CREATE INDEX IF NOT EXISTS probes_status ON probes (flags, "rez.mat", analysis_pkl)')
+
+    def connect(self):
+        return db_tools.connect(self.db_file)
+
+    def get_scanned(self):
+        """{session: {'complete': bool, 'mtimes': {path: modified time or None}}} of every indexed session"""
+        with self.connect() as db:
+            sessions = db.execute("SELECT session, complete FROM sessions").fetchall()
+            mtimes = db.execute("SELECT session, path, mtime FROM mtimes").fetchall()
+        scanned = {session: {'complete': bool(complete), 'mtimes': {}} for session, complete in sessions}
+        for session, path, mtime in mtimes:
+            scanned[session]['mtimes'][path] = mtime
+        return scanned
+
+    def replace_session(self, session, rows, mtimes, complete):
+        """Replaces a session's rows and folder modified times with a new scan."""
+        placeholders = ",".join(["?"]*(len(self.columns)+1))
+        with self.connect() as db:
+            for table in ['probes', 'sessions', 'mtimes']:
+                db.execute("DELETE FROM {} WHERE session=?".format(table), (session,))
+            db.executemany("INSERT OR REPLACE INTO probes VALUES ({})".format(placeholders),
+                            [[row[c] for c in self.columns] + [n] for n, row in enumerate(rows)])
+            db.executemany("INSERT INTO mtimes VALUES (?,?,?)", [(session, path, mtime) for path, mtime in mtimes.items()])
+            db.execute("INSERT INTO sessions VALUES (?,?,?)", (session, int(complete), time.time()))
+
+    def remove_sessions(self, sessions):
+        """Removes sessions that are no longer in the data folder."""
+        with self.connect() as db:
+            for session in sessions:
+                for table in ['probes', 'sessions', 'mtimes']:
+                    db.execute("DELETE FROM {} WHERE session=?".format(table), (session,))
+
+    def get_df(self, where=None):
+        """The indexed rows (matching the SQL condition where, if given) as a df in scan order"""
+        columns = ", ".join(['"{}"'.format(c) for c in self.columns])
+        sql = "SELECT {} FROM probes".format(columns)
+        if where is not None:
+            sql += " WHERE {}".format(where)
+        return self.query(sql + " ORDER BY session, position")
+
+    def query(self, sql, values=()):
+        """Runs a SELECT on the index and returns the result as a df"""
+        with self.connect() as db:
+            cursor = db.execute(sql, values)
+            columns = [d[0] for d in cursor.description]
+            rows = cursor.fetchall()
+        return pd.DataFrame(rows, columns=columns)
+
+    def n_rows(self):
+        with self.connect() as db:
+            return db.execute("SELECT COUNT(*) FROM probes").fetchone()[0]
+
 if __name__ == "__main__":
     SessionSummary(save=True).generate_session_df()
@@ -0,0 +1,39 @@
+import sqlite3
+
+
+def connect(db_file, rows_as_dicts=False):
+    """
+    Opens a SQLite file (created if it doesn't exist) for one closing_transaction. Waits up to a minute for other
+    processes' transactions to finish. The file should be on a local disk, SQLite locking isn't reliable on network shares.
+
+    Parameters
+    ----------
+    db_file: path
+    rows_as_dicts: bool, optional
+        Return rows as sqlite3.Row, which can be read by column name. default = False
+
+    Returns
+    ----------
+    closing_transaction of the connection, to use in a with block
+    """
+    db = sqlite3.connect(db_file, timeout=60, isolation_level=None)
+    if rows_as_dicts==True:
+        db.row_factory = sqlite3.Row
+    return closing_transaction(db)
+
+
+class closing_transaction():
+    """Context manager that runs the statements in its block as one immediate transaction and closes the connection."""
+    def __init__(self, db):
+        self.db = db
+
+    def __enter__(self):
+        self.db.execute("BEGIN IMMEDIATE")
+        return self.db
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.db.execute("COMMIT")
+        else:
+            self.db.execute("ROLLBACK")
+        self.db.close()
@@ -6,6 +6,8 @@ import pandas as pd
 import json
 
 import np2_ultra.tools.io as io
+import np2_ultra.tools.analysis_tools as ant
+import np2_ultra.tools.compress_tools as ct
 
 
 class GetFiles():
@@ -107,16 +109,20 @@ class GetFiles():
             print("Gain factor returned as gain_factor.")
 
 
-    def get_data_dict(self, recording, probe):
+    def get_data_dict(self, recording, probe, legacy_opto=True):
         """
         recording: str in format "recordingN" where N is the recording number
         probe: str in format of a capital letter indicating the probe cartridge position
+        legacy_opto: bool, if True opto data saved as a tensor is presented as the nested dictionary
         data_dict: the waveform and opto data as a dictionary
         """
-        pkl_dir = os.path.join(self.analysis_dir, self.s_id, "probe{}".format(probe))
+        pkl_dir = os.path.join(self.analysis_dir, "probe{}".format(probe))
         try:
-            pkl_file = [f for f in pkl_dir if recording[0] in f][0]
+            pkl_files = os.listdir(pkl_dir) if os.path.exists(pkl_dir) else []
+            pkl_file = [os.path.join(pkl_dir, f) for f in pkl_files if ("{}_probe".format(recording) in f) and f.endswith(".pkl")][0]
             self.data_dict = pd.read_pickle(pkl_file)
+            if legacy_opto==True:
+                self.data_dict['opto_data'] = ant.opto_tensor_to_dict(self.data_dict['opto_data'])
             if self.verbose==True:
                 print("Data dictionary returned as data_dict.")
         except IndexError:
@@ -127,7 +133,18 @@ class GetFiles():
         """
         recording: str in format "recordingN" where N is the recording number
         probe: str in format of a capital letter indicating the probe cartridge position
-        raw_data: raw data as a numpy memmap array
+        raw_data: raw data as a (channels, samples) numpy memmap array, or a compress_tools.CompressedDat view that can be
+            sliced the same way if only the compressed continuous.cdat is there
+        """
+        raw_data_file = self.get_raw_data_file(recording, probe, band=band)
+        raw_data = ct.open_continuous(raw_data_file, 384).T
+        return raw_data
+
+    def get_raw_data_file(self, recording, probe, band='spike'):
+        """
+        recording: str in format "recordingN" where N is the recording number
+        probe: str in format of a capital letter indicating the probe cartridge position
+        raw_data_file: path to the continuous.dat file, or to continuous.cdat if the data is only stored compressed
         """
         if self.probe_data_dirs==False:
             self.get_probe_dirs("all")
@@ -136,9 +153,9 @@ class GetFiles():
         elif band=='lfp':
             data_dir = os.path.join()
         raw_data_file = os.path.join(data_dir, "continuous.dat")
-        rawData = np.memmap(raw_data_file,dtype='int16',mode='r')
-        raw_data = np.reshape(rawData, (int(rawData.size/384), 384)).T
-        return raw_data
+        if (os.path.exists(raw_data_file)==False) and os.path.exists(ct.compressed_path(raw_data_file)):
+            raw_data_file = ct.compressed_path(raw_data_file)
+        return raw_data_file
 
     def get_channel_positions(self, data_dir):
         """channel_pos: numpy array of channel positions"""
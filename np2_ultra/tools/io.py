@@ -46,3 +46,16 @@ def get_paths_to_kilosort_templates():
     ultra = os.path.join(os.getcwd(), "kilosort_main_ultra.m")
     os.chdir(current_dir)
     return one_oh, ultra
+
+def get_local_state_file(file_name, computer_names=None):
+    '''
+    Path of a state file, eg the kilosort queue, on this computer's own disk: in the folder given as "local_state" in
+    computer_names.json if there is one, otherwise in an np2_ultra folder in the home directory. SQLite files are kept
+    off dest_root because locking isn't reliable on network shares.
+    '''
+    if computer_names is None:
+        computer_names = read_computer_names()
+    state_dir = computer_names.get("local_state", os.path.join(os.path.expanduser("~"), "np2_ultra"))
+    if os.path.exists(state_dir)==False:
+        os.makedirs(state_dir)
+    return os.path.join(state_dir, file_name)
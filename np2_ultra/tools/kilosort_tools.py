@@ -0,0 +1,343 @@
+import os
+import json
+import time
+import socket
+import numpy as np
+
+from np2_ultra.tools import db_tools
+
+
+class ClusterIndex():
+    """
+    Grouped index of kilosort spikes by cluster, built once from spike_clusters.npy.
+    Spikes are grouped with a stable argsort and each cluster's spikes are found from an offsets array (CSR style),
+    so looking up a cluster's spikes doesn't rescan the whole spike train.
+
+    Methods
+    ----------
+    spike_indices(cluster_id)
+    spike_counts()
+    """
+    def __init__(self, spike_clusters):
+        """
+        Parameters
+        ----------
+        spike_clusters: array
+            Cluster assignment of each spike, as loaded from spike_clusters.npy
+        """
+        spike_clusters = np.asarray(spike_clusters).ravel()
+        self.order = np.argsort(spike_clusters, kind='stable')
+        self.cluster_ids, starts = np.unique(spike_clusters[self.order], return_index=True)
+        self.offsets = np.append(starts, spike_clusters.size)
+        self.cluster_lookup = {c: n for n, c in enumerate(self.cluster_ids.tolist())}
+
+    def __contains__(self, cluster_id):
+        return int(cluster_id) in self.cluster_lookup
+
+    def spike_indices(self, cluster_id):
+        """
+        Returns the indices of the cluster's spikes in ascending order, the same as np.where(spike_clusters == cluster_id)[0].
+        Clusters with no spikes return an empty array.
+        """
+        try:
+            n = self.cluster_lookup[int(cluster_id)]
+        except KeyError:
+            return self.order[:0]
+        return self.order[self.offsets[n]:self.offsets[n+1]]
+
+    def spike_counts(self):
+        """
+        Returns a dictionary of the number of spikes in each cluster.
+        """
+        return dict(zip(self.cluster_ids.tolist(), np.diff(self.offsets).tolist()))
+
+
+class OffsetArray():
+    """
+    Read-only view of an array with a constant offset added to whatever is read from it.
+    Lets memory-mapped spike times be used with the recording start offset applied, without loading or rewriting them.
+    """
+    def __init__(self, base, offset):
+        self.base = base
+        self.offset = offset
+
+    @property
+    def shape(self):
+        return self.base.shape
+
+    @property
+    def size(self):
+        return self.base.size
+
+    def __len__(self):
+        return len(self.base)
+
+    def __getitem__(self, key):
+        return self.base[key] + self.offset
+
+    def __array__(self, dtype=None, copy=None):
+        values = np.asarray(self.base) + self.offset
+        if dtype is not None:
+            values = values.astype(dtype)
+        return values
+
+
+def load_spike_data(data_dir, timestamps_file):
+    """
+    Memory-maps the kilosort spike times and cluster assignments of a probe without modifying them.
+    The recording start offset (first value of the recording's timestamps.npy) is recorded in spike_times_offset.json
+    in data_dir, with the size and modified time of timestamps.npy so it's read again if that changes, and applied
+    lazily through an OffsetArray, instead of being written into spike_times.npy.
+    Folders processed with analysis_tools.fix_spike_times, where spike_times.npy already holds the offset times and
+    spike_times_old.npy the original ones, are still read correctly.
+
+    Parameters
+    ----------
+    data_dir: path
+        The probe's kilosort output folder
+    timestamps_file: path
+        The recording's timestamps.npy
+
+    Returns
+    ----------
+    spike_data: dict with keys
+        spike_times: memmap of the spike times in samples as output by kilosort
+        spike_times_offset: OffsetArray of the spike times with the recording start offset added
+        spike_clusters: memmap of the cluster assignment of each spike
+        t0: the recording start offset in samples
+    """
+    offset_file = os.path.join(data_dir, 'spike_times_offset.json')
+    timestamps_stat = os.stat(timestamps_file)
+    fingerprint = [timestamps_stat.st_size, timestamps_stat.st_mtime]
+    saved = {}
+    if os.path.exists(offset_file):
+        try:
+            with open(offset_file, 'r') as f:
+                saved = json.load(f)
+        except ValueError:
+            pass
+    if saved.get('fingerprint') == fingerprint:
+        t0 = saved['t0']
+    else:
+        t0 = np.load(timestamps_file, mmap_mode='r')[0].item()
+        temp_file = offset_file + ".partial"
+        try:
+            with open(temp_file, 'w') as f:
+                json.dump({'t0': t0, 'timestamps_file': timestamps_file, 'fingerprint': fingerprint}, f)
+            os.replace(temp_file, offset_file)
+        except OSError as e:
+            print("Couldn't record the spike time offset in {}: {}".format(offset_file, e))
+
+    old_spike_times_file = os.path.join(data_dir, 'spike_times_old.npy')
+    if os.path.exists(old_spike_times_file):
+        spike_times = np.load(old_spike_times_file, mmap_mode='r')
+    else:
+        spike_times = np.load(os.path.join(data_dir, 'spike_times.npy'), mmap_mode='r')
+
+    spike_data = {'spike_times': spike_times,
+                'spike_times_offset': OffsetArray(spike_times, t0),
+                'spike_clusters': np.load(os.path.join(data_dir, 'spike_clusters.npy'), mmap_mode='r'),
+                't0': t0}
+    return spike_data
+
+
+QUEUE_STATES = ['pending', 'running', 'done', 'failed', 'skipped']
+
+
+def process_running(pid):
+    """True if a process with id pid is running on this computer."""
+    if os.name == 'nt':
+        # os.kill would terminate the process on Windows, so ask for its exit code instead
+        import ctypes
+        kernel32 = ctypes.windll.kernel32
+        handle = kernel32.OpenProcess(0x1000, False, pid) # PROCESS_QUERY_LIMITED_INFORMATION
+        if not handle:
+            return False
+        exit_code = ctypes.c_ulong()
+        found = kernel32.GetExitCodeProcess(handle, ctypes.byref(exit_code))
+        kernel32.CloseHandle(handle)
+        return bool(found) and (exit_code.value == 259) # STILL_ACTIVE
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class KilosortQueue():
+    """
+    Durable queue of kilosort jobs, one per session/recording/probe, kept in a SQLite file so it survives crashes and
+    can be shared by every process sorting on the same computer. Each job records its state (pending, running, done,
+    failed or skipped), number of attempts, how long the last attempt took and the last error. A failed attempt puts the
+    job back to pending until it has used max_attempts attempts, after which it stays failed until retry() is called.
+    Jobs are only started from a state other than running, so a job is never sorted twice at once. A running job
+    records the computer and process sorting it; if that process has ended (it crashed, was killed or the computer was
+    restarted) the job is taken over by the next start(), or put back to pending by requeue_orphaned().
+    The queue file must be on a local disk (see io.get_local_state_file) and only used by one computer, SQLite locking
+    isn't reliable on network shares.
+
+    Methods
+    ----------
+    add(session, recording, probe, probe_dir, priority=0)
+    start(session, recording, probe)
+    claim(session=None)
+    finish(job, state='done', note=None)
+    fail(job, error)
+    release(job)
+    retry(session=None, recording=None, probe=None)
+    requeue_stale(max_hours=24)
+    requeue_orphaned()
+    counts(session=None)
+    jobs(session=None)
+    """
+    def __init__(self, db_file, max_attempts=2):
+        """
+        Parameters
+        ----------
+        db_file: path
+            SQLite file of the queue, created if it doesn't exist
+        max_attempts: int, optional
+            Attempts a job gets before it's left failed. default = 2
+        """
+        self.db_file = db_file
+        self.max_attempts = max_attempts
+        with self.connect() as db:
+            db.execute("""CREATE TABLE IF NOT EXISTS jobs (
+                            session TEXT, recording TEXT, probe TEXT, probe_dir TEXT,
+                            state TEXT, priority INTEGER, attempts INTEGER, max_attempts INTEGER,
+                            queued_at REAL, started_at REAL, finished_at REAL, duration REAL,
+                            error TEXT, host TEXT, pid INTEGER,
+                            PRIMARY KEY (session, recording, probe))""")
+            # queues made before the process id was recorded
+            if 'pid' not in [row['name'] for row in db.execute("PRAGMA table_info(jobs)").fetchall()]:
+                db.execute("ALTER TABLE jobs ADD COLUMN pid INTEGER")
+
+    def connect(self):
+        return db_tools.connect(self.db_file, rows_as_dicts=True)
+
+    def add(self, session, recording, probe, probe_dir, priority=0):
+        """
+        Adds a job as pending if it isn't in the queue yet. Returns the job's state.
+        """
+        with self.connect() as db:
+            db.execute("""INSERT OR IGNORE INTO jobs (session, recording, probe, probe_dir, state, priority, attempts, max_attempts, queued_at)
+                            VALUES (?,?,?,?,'pending',?,0,?,?)""",
+                        (session, recording, probe, probe_dir, priority, self.max_attempts, time.time()))
+            row = db.execute("SELECT state FROM jobs WHERE session=? AND recording=? AND probe=?", (session, recording, probe)).fetchone()
+        return row['state']
+
+    def start(self, session, recording, probe):
+        """
+        Marks a job as running and counts the attempt, unless it's already running in a process that's still going.
+        A job left running by a process on this computer that has ended is taken over.
+        Returns the job as a dictionary, or None if it's already running (eg claimed by drain_queue).
+        """
+        now = time.time()
+        host = socket.gethostname()
+        with self.connect() as db:
+            row = db.execute("SELECT state, host, pid FROM jobs WHERE session=? AND recording=? AND probe=?", (session, recording, probe)).fetchone()
+            if row['state'] == 'running':
+                if (row['host'] != host) or ((row['pid'] is not None) and process_running(row['pid'])):
+                    return None
+                print("{} {} {} was left running by process {}, which has ended. Taking it over.".format(session, recording, probe, row['pid']))
+            db.execute("UPDATE jobs SET state='running', attempts=attempts+1, started_at=?, host=?, pid=? WHERE session=? AND recording=? AND probe=?",
+                        (now, host, os.getpid(), session, recording, probe))
+            row = db.execute("SELECT * FROM jobs WHERE session=? AND recording=? AND probe=?", (session, recording, probe)).fetchone()
+        return dict(row)
+
+    def claim(self, session=None):
+        """
+        Takes the highest priority, longest waiting pending job (of one session, if given) and marks it as running.
+        Returns the job as a dictionary, or None if there are no pending jobs.
+        """
+        now = time.time()
+        host = socket.gethostname()
+        with self.connect() as db:
+            if session is None:
+                row = db.execute("SELECT * FROM jobs WHERE state='pending' ORDER BY priority DESC, queued_at LIMIT 1").fetchone()
+            else:
+                row = db.execute("SELECT * FROM jobs WHERE state='pending' AND session=? ORDER BY priority DESC, queued_at LIMIT 1", (session,)).fetchone()
+            if row is None:
+                return None
+            db.execute("UPDATE jobs SET state='running', attempts=attempts+1, started_at=?, host=?, pid=? WHERE session=? AND recording=? AND probe=?",
+                        (now, host, os.getpid(), row['session'], row['recording'], row['probe']))
+        job = dict(row)
+        job.update({'state': 'running', 'attempts': row['attempts'] + 1, 'started_at': now, 'host': host, 'pid': os.getpid()})
+        return job
+
+    def finish(self, job, state='done', note=None):
+        """Marks a job as done (or skipped) and records how long it took."""
+        now = time.time()
+        duration = None if job.get('started_at') is None else now - job['started_at']
+        with self.connect() as db:
+            db.execute("UPDATE jobs SET state=?, finished_at=?, duration=?, error=? WHERE session=? AND recording=? AND probe=?",
+                        (state, now, duration, note, job['session'], job['recording'], job['probe']))
+
+    def fail(self, job, error):
+        """
+        Records a failed attempt. The job goes back to pending if it has attempts left, otherwise it's failed.
+        Returns the job's new state.
+        """
+        now = time.time()
+        duration = None if job.get('started_at') is None else now - job['started_at']
+        with self.connect() as db:
+            row = db.execute("SELECT attempts, max_attempts FROM jobs WHERE session=? AND recording=? AND probe=?",
+                            (job['session'], job['recording'], job['probe'])).fetchone()
+            state = 'pending' if row['attempts'] < row['max_attempts'] else 'failed'
+            db.execute("UPDATE jobs SET state=?, finished_at=?, duration=?, error=? WHERE session=? AND recording=? AND probe=?",
+                        (state, now, duration, str(error), job['session'], job['recording'], job['probe']))
+        return state
+
+    def release(self, job):
+        """Puts a running job back to pending without counting the attempt, eg when sorting it was interrupted."""
+        with self.connect() as db:
+            db.execute("UPDATE jobs SET state='pending', attempts=MAX(attempts-1, 0) WHERE session=? AND recording=? AND probe=? AND state='running'",
+                        (job['session'], job['recording'], job['probe']))
+
+    def retry(self, session=None, recording=None, probe=None):
+        """Puts failed jobs (all of them, or those matching the given session/recording/probe) back to pending with fresh attempts."""
+        query = "UPDATE jobs SET state='pending', attempts=0, queued_at=? WHERE state='failed'"
+        values = [time.time()]
+        for column, value in [('session', session), ('recording', recording), ('probe', probe)]:
+            if value is not None:
+                query += " AND {}=?".format(column)
+                values.append(value)
+        with self.connect() as db:
+            db.execute(query, values)
+
+    def requeue_stale(self, max_hours=24):
+        """Puts jobs that have been running for more than max_hours (eg their process was killed) back to pending."""
+        with self.connect() as db:
+            db.execute("UPDATE jobs SET state='pending' WHERE state='running' AND started_at<?", (time.time() - max_hours*3600,))
+
+    def requeue_orphaned(self):
+        """Puts jobs left running by processes on this computer that have ended (crashed, killed, or the computer restarted) back to pending."""
+        host = socket.gethostname()
+        with self.connect() as db:
+            rows = db.execute("SELECT session, recording, probe, pid FROM jobs WHERE state='running' AND host=?", (host,)).fetchall()
+            for row in rows:
+                if (row['pid'] is None) or (process_running(row['pid'])==False):
+                    db.execute("UPDATE jobs SET state='pending' WHERE session=? AND recording=? AND probe=?", (row['session'], row['recording'], row['probe']))
+
+    def counts(self, session=None):
+        """Number of jobs in each state, eg the queue depth is counts()['pending']."""
+        with self.connect() as db:
+            if session is None:
+                rows = db.execute("SELECT state, COUNT(*) AS n FROM jobs GROUP BY state").fetchall()
+            else:
+                rows = db.execute("SELECT state, COUNT(*) AS n FROM jobs WHERE session=? GROUP BY state", (session,)).fetchall()
+        counts = {state: 0 for state in QUEUE_STATES}
+        counts.update({row['state']: row['n'] for row in rows})
+        return counts
+
+    def jobs(self, session=None):
+        """Every job (of one session, if given) as a list of dictionaries."""
+        with self.connect() as db:
+            if session is None:
+                rows = db.execute("SELECT * FROM jobs ORDER BY session, recording, probe").fetchall()
+            else:
+                rows = db.execute("SELECT * FROM jobs WHERE session=? ORDER BY recording, probe", (session,)).fetchall()
+        return [dict(row) for row in rows]
+
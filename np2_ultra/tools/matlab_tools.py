@@ -0,0 +1,124 @@
+import queue
+import threading
+from contextlib import contextmanager
+
+import matlab.engine
+
+ENGINE_POOLS = {}
+POOLS_LOCK = threading.Lock()
+
+
+class EnginePool():
+    """
+    Keeps a number of MATLAB engines running so jobs don't pay the engine start up time.
+    Each job takes an engine with engine(); an engine that stops responding after a job is replaced, and every engine
+    is replaced after max_jobs jobs so memory leaked by long MATLAB sessions is given back.
+
+    Methods
+    ----------
+    engine()
+    shutdown()
+    """
+    def __init__(self, size=1, max_jobs=20, reset_command="clear all; fclose('all');", paths=None):
+        """
+        Parameters
+        ----------
+        size: int, optional
+            Number of engines, ie how many jobs can run at once. default = 1
+        max_jobs: int, optional
+            Jobs an engine runs before it's replaced. None never replaces healthy engines. default = 20
+        reset_command: str, optional
+            MATLAB command run after every job to clear the workspace. default clears variables and closes files
+        paths: list of paths, optional
+            Folders added to every engine's MATLAB path when it starts
+        """
+        self.size = size
+        self.max_jobs = max_jobs
+        self.reset_command = reset_command
+        self.paths = [] if paths is None else list(paths)
+        self.idle = queue.Queue()
+        for n in range(size):
+            # engines start in the background; a job that gets one waits for it to finish starting
+            self.idle.put(self.start_engine())
+
+    def start_engine(self):
+        return [matlab.engine.start_matlab(background=True), 0]
+
+    @staticmethod
+    def is_alive(eng):
+        try:
+            eng.eval('1;', nargout=0)
+            return True
+        except Exception:
+            return False
+
+    def quit_engine(self, eng):
+        try:
+            eng.quit()
+        except Exception:
+            pass
+
+    @contextmanager
+    def engine(self):
+        """
+        Context manager that waits for an idle engine and gives it back (or replaces it) when the job is done.
+
+        Example
+        ----------
+        with pool.engine() as eng:
+            eng.my_script(nargout=0)
+        """
+        slot = self.idle.get()
+        if isinstance(slot[0], matlab.engine.FutureResult):
+            try:
+                slot[0] = slot[0].result()
+                for path in self.paths:
+                    slot[0].addpath(path, nargout=0)
+            except Exception as e:
+                print("MATLAB engine failed to start ({}), starting another one.".format(e))
+                self.idle.put(self.start_engine())
+                raise
+        eng = slot[0]
+        try:
+            yield eng
+        finally:
+            slot[1] += 1
+            healthy = self.is_alive(eng)
+            if healthy==True:
+                try:
+                    eng.eval(self.reset_command, nargout=0)
+                except Exception:
+                    healthy = False
+            if healthy==False:
+                print("MATLAB engine stopped responding, replacing it.")
+                self.quit_engine(eng)
+                self.idle.put(self.start_engine())
+            elif (self.max_jobs is not None) and (slot[1] >= self.max_jobs):
+                self.quit_engine(eng)
+                self.idle.put(self.start_engine())
+            else:
+                self.idle.put(slot)
+
+    def shutdown(self):
+        """Quits every idle engine. Call once the jobs using the pool are done."""
+        while self.idle.empty()==False:
+            slot = self.idle.get()
+            eng = slot[0]
+            if isinstance(eng, matlab.engine.FutureResult):
+                try:
+                    eng = eng.result()
+                except Exception:
+                    continue
+            self.quit_engine(eng)
+
+
+def get_engine_pool(size=1, **kwargs):
+    """
+    Returns the process-wide EnginePool of the given size, starting it the first time it's asked for,
+    so sessions run one after another in the same process reuse warm engines.
+    kwargs are passed to EnginePool when it's created.
+    """
+    with POOLS_LOCK:
+        if size not in ENGINE_POOLS:
+            ENGINE_POOLS[size] = EnginePool(size, **kwargs)
+        return ENGINE_POOLS[size]
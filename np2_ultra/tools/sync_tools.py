@@ -0,0 +1,194 @@
+import os
+import json
+import numpy as np
+
+from allensdk.brain_observatory.ecephys.align_timestamps import barcode
+from allensdk.brain_observatory.ecephys.align_timestamps import channel_states as cs
+from allensdk.brain_observatory.sync_dataset import Dataset
+
+
+class SyncCache():
+    """
+    Stands in for an allensdk sync Dataset using edges cached in a sidecar file next to the *_sync.h5 file.
+    The sidecar holds the rising and falling edges of every labelled line and the decoded barcode_ephys barcodes,
+    and is rebuilt from the h5 file whenever the h5 file's size or modified time changes.
+    Supports the parts of Dataset used in this package, so it can be passed to analysis_tools.get_sync_line_data.
+
+    Methods
+    ----------
+    build_cache()
+    load_cache()
+    get_rising_edges(line)
+    get_falling_edges(line)
+    """
+    def __init__(self, sync_file, rebuild=False):
+        """
+        Parameters
+        ----------
+        sync_file: path
+            The *_sync.h5 file
+        rebuild: bool, optional
+            Rebuild the cache even if it's valid. default = False
+        """
+        self.sync_file = sync_file
+        self.cache_file = os.path.splitext(sync_file)[0] + "_cache.npz"
+        sync_stat = os.stat(sync_file)
+        self.fingerprint = np.array([sync_stat.st_size, sync_stat.st_mtime])
+
+        if (rebuild==True) or (self.load_cache()==False):
+            self.build_cache()
+
+    def load_cache(self):
+        """
+        Loads the sidecar cache. Returns False if it doesn't exist or doesn't match the sync file.
+        """
+        if os.path.exists(self.cache_file)==False:
+            return False
+        with np.load(self.cache_file) as cache:
+            if np.array_equal(cache['fingerprint'], self.fingerprint)==False:
+                return False
+            self.line_labels = [str(label) for label in cache['line_labels']]
+            self.sample_freq = float(cache['sample_freq'])
+            self.counter_output_freq = float(cache['counter_output_freq'])
+            self.rising = {int(k.split('_')[1]): cache[k] for k in cache.files if k.startswith('rising_')}
+            self.falling = {int(k.split('_')[1]): cache[k] for k in cache.files if k.startswith('falling_')}
+            self.barcode_times = cache['barcode_times']
+            self.barcodes = cache['barcodes']
+        self.meta_data = {'ni_daq': {'counter_output_freq': self.counter_output_freq}}
+        return True
+
+    def build_cache(self):
+        """
+        Reads the edges of every labelled line from the sync h5 file, decodes the ephys barcodes and writes the sidecar cache.
+        """
+        print("Building sync cache for {}".format(os.path.basename(self.sync_file)))
+        sync_dataset = Dataset(self.sync_file)
+        self.line_labels = list(sync_dataset.line_labels)
+        self.sample_freq = float(sync_dataset.sample_freq)
+        self.counter_output_freq = float(sync_dataset.meta_data['ni_daq']['counter_output_freq'])
+        self.meta_data = {'ni_daq': {'counter_output_freq': self.counter_output_freq}}
+        self.rising = {}
+        self.falling = {}
+        for channel, label in enumerate(self.line_labels):
+            if label not in ('', None):
+                self.rising[channel] = sync_dataset.get_rising_edges(channel)
+                self.falling[channel] = sync_dataset.get_falling_edges(channel)
+        sync_dataset.close()
+
+        if 'barcode_ephys' in self.line_labels:
+            barcode_channel = self.line_labels.index('barcode_ephys')
+            on_times = self.rising[barcode_channel] / self.sample_freq
+            off_times = self.falling[barcode_channel] / self.sample_freq
+            self.barcode_times, self.barcodes = barcode.extract_barcodes_from_times(on_times, off_times)
+        else:
+            self.barcode_times, self.barcodes = np.array([]), np.array([])
+
+        arrays = {'fingerprint': self.fingerprint,
+                'line_labels': np.array(self.line_labels, dtype=str),
+                'sample_freq': self.sample_freq,
+                'counter_output_freq': self.counter_output_freq,
+                'barcode_times': np.asarray(self.barcode_times),
+                'barcodes': np.asarray(self.barcodes)}
+        for channel in self.rising.keys():
+            arrays['rising_{}'.format(channel)] = self.rising[channel]
+            arrays['falling_{}'.format(channel)] = self.falling[channel]
+        temp_file = self.cache_file[:-len(".npz")] + "_partial.npz"
+        try:
+            np.savez(temp_file, **arrays)
+            os.replace(temp_file, self.cache_file)
+        except OSError as e:
+            print("Couldn't write sync cache {}: {}".format(self.cache_file, e))
+
+    def _line_to_bit(self, line):
+        if isinstance(line, str):
+            return self.line_labels.index(line)
+        return line
+
+    def get_rising_edges(self, line):
+        """Rising edges of a labelled line, in samples."""
+        return self.rising[self._line_to_bit(line)]
+
+    def get_falling_edges(self, line):
+        """Falling edges of a labelled line, in samples."""
+        return self.falling[self._line_to_bit(line)]
+
+
+def file_fingerprint(path):
+    """Returns [size, modified time] of a file, used to tell if a cached result is stale."""
+    file_stat = os.stat(path)
+    return [file_stat.st_size, file_stat.st_mtime]
+
+def get_probe_alignments(recording_dir, event_dirs, sync_cache, probe_sample_rate=30000., rebuild=False):
+    """
+    Gets the offset and sample rate that align each probe's clock to the sync clock, for all probes of a recording in one pass.
+    Results are kept in probe_alignment.json in the recording folder, keyed on the size and modified time of the sync file,
+    the recording timestamps.npy and each probe's event files, and are only recomputed for probes whose inputs changed.
+
+    Parameters
+    ----------
+    recording_dir: path
+        The recording folder
+    event_dirs: dict
+        Event folder (with channel_states.npy and timestamps.npy) of each probe to align, keyed by probe letter
+    sync_cache: SyncCache
+        The recording's sync cache
+    probe_sample_rate: float, optional
+        Nominal probe sample rate. default = 30000.
+    rebuild: bool, optional
+        Recompute all probes even if cached. default = False
+
+    Returns
+    ----------
+    probe_alignments: dict keyed by probe letter of {'probe_shift': seconds, 'probe_rate': probe sample rate on the sync clock}
+    """
+    alignment_file = os.path.join(recording_dir, 'probe_alignment.json')
+    timestamps_file = os.path.join(recording_dir, 'timestamps.npy')
+    recording_fingerprint = {'sync': sync_cache.fingerprint.tolist(),
+                            'timestamps': file_fingerprint(timestamps_file),
+                            'probe_sample_rate': probe_sample_rate}
+
+    cached = {}
+    if (rebuild==False) and os.path.exists(alignment_file):
+        with open(alignment_file, 'r') as f:
+            stored = json.load(f)
+        if stored.get('fingerprint') == recording_fingerprint:
+            cached = stored['probes']
+
+    probes = dict(cached)
+    recording_timestamp_zero = None
+    for probe, events_folder in event_dirs.items():
+        channel_states_file = os.path.join(events_folder, 'channel_states.npy')
+        event_times_file = os.path.join(events_folder, 'timestamps.npy')
+        fingerprint = [file_fingerprint(channel_states_file), file_fingerprint(event_times_file)]
+        if (probe in cached) and (cached[probe]['fingerprint'] == fingerprint):
+            continue
+
+        if recording_timestamp_zero is None:
+            recording_timestamp_zero = np.load(timestamps_file, mmap_mode='r')[0]
+        channel_states = np.load(channel_states_file)
+        event_times = np.load(event_times_file) - recording_timestamp_zero
+        probe_barcode_times, probe_barcodes = cs.extract_barcodes_from_states(channel_states,
+                                                                            event_times, probe_sample_rate)
+        probe_shift, probe_rate, __ = barcode.get_probe_time_offset(master_times = sync_cache.barcode_times,
+                                                                    master_barcodes = sync_cache.barcodes,
+                                                                    probe_times = probe_barcode_times,
+                                                                    probe_barcodes = probe_barcodes,
+                                                                    acq_start_index = 0,
+                                                                    local_probe_rate = probe_sample_rate,
+                                                                    )
+        probes[probe] = {'fingerprint': fingerprint,
+                        'probe_shift': float(probe_shift),
+                        'probe_rate': float(probe_rate)}
+
+    if probes != cached:
+        temp_file = alignment_file + ".partial"
+        try:
+            with open(temp_file, 'w') as f:
+                json.dump({'fingerprint': recording_fingerprint, 'probes': probes}, f, indent=1)
+            os.replace(temp_file, alignment_file)
+        except OSError as e:
+            print("Couldn't write probe alignment file {}: {}".format(alignment_file, e))
+
+    probe_alignments = {probe: {'probe_shift': probes[probe]['probe_shift'], 'probe_rate': probes[probe]['probe_rate']}
+                        for probe in event_dirs.keys()}
+    return probe_alignments
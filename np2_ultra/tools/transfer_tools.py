@@ -0,0 +1,497 @@
+import os
+import shutil
+import time
+import json
+import zlib
+import threading
+import fnmatch
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+
+import np2_ultra.tools.compress_tools as ct
+
+COPY_BUFFER_SIZE = 16*1024*1024
+MANIFEST_NAME = 'transfer_manifest.json'
+MTIME_WINDOW = 2.
+JOURNAL_INTERVAL = 10.
+MANIFEST_INTERVAL = 10.
+
+
+def source_host(path):
+    """
+    Returns the computer a path is read from: the host of a UNC path (\\\\host\\share\\...), otherwise the drive or 'local'.
+    """
+    path = str(path)
+    if path.startswith('\\\\') or path.startswith('//'):
+        return path.replace('/', '\\').lstrip('\\').split('\\')[0].lower()
+    drive = os.path.splitdrive(path)[0]
+    if drive != '':
+        return drive.lower()
+    return 'local'
+
+def write_json(path, contents):
+    """Writes contents to a json file through a temporary file, so the file is never left half written."""
+    temp_file = path + '.tmp'
+    with open(temp_file, 'w') as f:
+        json.dump(contents, f, indent=1)
+    os.replace(temp_file, path)
+
+def file_crc32(path, buffer_size=COPY_BUFFER_SIZE, length=None):
+    """Returns the CRC32 checksum of a file, or of its first length bytes."""
+    crc = 0
+    remaining = length
+    with open(path, 'rb') as f:
+        chunk = f.read(buffer_size if remaining is None else min(buffer_size, remaining))
+        while len(chunk) > 0:
+            crc = zlib.crc32(chunk, crc)
+            if remaining is not None:
+                remaining -= len(chunk)
+                if remaining == 0:
+                    break
+            chunk = f.read(buffer_size if remaining is None else min(buffer_size, remaining))
+    return crc
+
+def build_manifest(folder, hash_files=False, skip=(MANIFEST_NAME,)):
+    """
+    Lists every file under folder with its size and modified time, reading each directory once with os.scandir.
+    Partially copied files (.partial and their journals) and the names in skip are left out.
+
+    Parameters
+    ----------
+    folder: path
+        Folder to list. A folder that doesn't exist gives an empty manifest.
+    hash_files: bool, optional
+        Also record the CRC32 checksum of each file. This reads every file. default = False
+    skip: tuple, optional
+        File names to leave out. default = (transfer_manifest.json,)
+
+    Returns
+    ----------
+    manifest: dict of {relative path: {'size', 'mtime'(, 'crc32')}}, paths use '/' separators
+    """
+    manifest = {}
+    if os.path.isdir(folder)==False:
+        return manifest
+    to_scan = ['']
+    while len(to_scan) > 0:
+        rel_dir = to_scan.pop()
+        with os.scandir(os.path.join(folder, rel_dir)) as entries:
+            for entry in entries:
+                rel_path = entry.name if rel_dir == '' else rel_dir + '/' + entry.name
+                if entry.is_dir():
+                    to_scan.append(rel_path)
+                elif (entry.name in skip) or entry.name.endswith('.partial') or entry.name.endswith('.partial.json') or entry.name.endswith('.tmp'):
+                    continue
+                else:
+                    stat = entry.stat()
+                    manifest[rel_path] = {'size': stat.st_size, 'mtime': stat.st_mtime}
+                    if hash_files==True:
+                        manifest[rel_path]['crc32'] = file_crc32(entry.path)
+    return manifest
+
+def entries_match(a, b, mtime_window=MTIME_WINDOW):
+    """
+    True if two manifest entries describe the same file: same size, modified times within mtime_window seconds
+    (network and backup drives don't all keep full timestamp precision), and same checksum if both have one.
+    """
+    if a['size'] != b['size']:
+        return False
+    if abs(a['mtime'] - b['mtime']) > mtime_window:
+        return False
+    if (a.get('crc32') is not None) and (b.get('crc32') is not None):
+        return a['crc32'] == b['crc32']
+    return True
+
+def diff_manifests(source, destination, mtime_window=MTIME_WINDOW):
+    """
+    Compares a source manifest against a destination manifest (see build_manifest).
+
+    Returns
+    ----------
+    changed: sorted list of relative paths that are missing from the destination or differ from the source
+    unchanged: sorted list of relative paths that are already the same at the destination
+    """
+    changed = []
+    unchanged = []
+    for rel_path, entry in source.items():
+        if (rel_path in destination) and entries_match(entry, destination[rel_path], mtime_window):
+            unchanged.append(rel_path)
+        else:
+            changed.append(rel_path)
+    return sorted(changed), sorted(unchanged)
+
+def read_journal(dst, src_stat, buffer_size=COPY_BUFFER_SIZE):
+    """
+    Returns (offset, crc32) that an interrupted copy to dst can resume from, or (0, 0) if there's no usable journal
+    for the current version of the source. The journaled part of the partial file is read back and its checksum
+    compared with the journal's before it's trusted.
+    """
+    partial_file = dst + '.partial'
+    journal_file = partial_file + '.json'
+    if (os.path.exists(journal_file)==False) or (os.path.exists(partial_file)==False):
+        return 0, 0
+    try:
+        with open(journal_file, 'r') as f:
+            journal = json.load(f)
+        if (journal['size'] == src_stat.st_size) and (journal['mtime'] == src_stat.st_mtime) and (os.path.getsize(partial_file) >= journal['offset']):
+            if file_crc32(partial_file, buffer_size, journal['offset']) == journal['crc32']:
+                return journal['offset'], journal['crc32']
+            print("{} doesn't match its journal, copying it again".format(partial_file))
+    except (ValueError, KeyError):
+        pass
+    return 0, 0
+
+def write_chunk(fdst, chunk, journal_file, journal=None):
+    """
+    Appends chunk to an open partial file. If journal is given, also flushes the file to disk and then records the
+    new offset in the journal.
+    """
+    fdst.write(chunk)
+    if journal is not None:
+        fdst.flush()
+        os.fsync(fdst.fileno())
+        write_json(journal_file, journal)
+
+def tee_copy(src, dsts, buffer_size=COPY_BUFFER_SIZE, verify=False):
+    """
+    Reads src once and writes it to every path in dsts, tee-style, computing a CRC32 checksum as it goes.
+    Each destination is written through dst.partial, with the writes to the different destinations done at the same
+    time while the next chunk is read. Every JOURNAL_INTERVAL seconds each partial file is flushed to disk and the copied
+    length and checksum are written to its journal (dst.partial.json). If the copy is interrupted, the next call checks
+    each journaled part of the partial files against its checksum and resumes from the smallest journaled offset of the
+    destinations, as long as the source hasn't changed. Each partial file is checked and renamed to its destination
+    only once the whole file is copied.
+
+    Parameters
+    ----------
+    src: path
+        File to copy
+    dsts: list of paths
+        Where to copy it
+    buffer_size: int, optional
+        Bytes read at a time. default = 16 MB
+    verify: bool, optional
+        Also re-read every destination and compare its checksum with the source's. default = False only checks sizes
+
+    Returns
+    ----------
+    entry: dict of the source 'size', 'mtime' and the 'crc32' checksum of the copied data
+    """
+    src_stat = os.stat(src)
+    partial_files = [dst + '.partial' for dst in dsts]
+    journal_files = [partial_file + '.json' for partial_file in partial_files]
+    for dst in dsts:
+        os.makedirs(os.path.dirname(dst), exist_ok=True)
+
+    journals = [read_journal(dst, src_stat, buffer_size) for dst in dsts]
+    offset, crc = min(journals, key=lambda x: x[0])
+    if offset > 0:
+        print("resuming {} from byte {}".format(os.path.basename(dsts[0]), offset))
+
+    fdsts = [open(partial_file, 'r+b' if offset > 0 else 'wb') for partial_file in partial_files]
+    writers = ThreadPoolExecutor(max_workers=len(dsts)) if len(dsts) > 1 else None
+    try:
+        with open(src, 'rb') as fsrc:
+            fsrc.seek(offset)
+            for fdst in fdsts:
+                fdst.seek(offset)
+                fdst.truncate()
+            chunk = fsrc.read(buffer_size)
+            last_journal = time.time()
+            while len(chunk) > 0:
+                crc = zlib.crc32(chunk, crc)
+                offset += len(chunk)
+                journal = None
+                if time.time() - last_journal >= JOURNAL_INTERVAL:
+                    journal = {'size': src_stat.st_size, 'mtime': src_stat.st_mtime, 'offset': offset, 'crc32': crc}
+                    last_journal = time.time()
+                if writers is None:
+                    write_chunk(fdsts[0], chunk, journal_files[0], journal)
+                    chunk = fsrc.read(buffer_size)
+                else:
+                    writes = [writers.submit(write_chunk, fdst, chunk, journal_file, journal) for fdst, journal_file in zip(fdsts, journal_files)]
+                    chunk = fsrc.read(buffer_size)
+                    for write in writes:
+                        write.result()
+    finally:
+        for fdst in fdsts:
+            fdst.close()
+        if writers is not None:
+            writers.shutdown()
+
+    if offset != src_stat.st_size:
+        raise IOError("{} changed size during the copy".format(src))
+    for dst, partial_file, journal_file in zip(dsts, partial_files, journal_files):
+        if os.path.getsize(partial_file) != src_stat.st_size:
+            raise IOError("{} is {} bytes, expected {}".format(partial_file, os.path.getsize(partial_file), src_stat.st_size))
+        if (verify==True) and (file_crc32(partial_file, buffer_size) != crc):
+            raise IOError("{} checksum doesn't match {}".format(partial_file, src))
+        shutil.copystat(src, partial_file)
+        os.replace(partial_file, dst)
+        if os.path.exists(journal_file):
+            os.remove(journal_file)
+    return {'size': src_stat.st_size, 'mtime': src_stat.st_mtime, 'crc32': crc}
+
+def resumable_copy(src, dst, buffer_size=COPY_BUFFER_SIZE):
+    """
+    Copies src to dst in chunks through dst.partial, journaling progress so an interrupted copy can resume.
+    See tee_copy.
+    """
+    return tee_copy(src, [dst], buffer_size)
+
+
+class SourceIndex():
+    """
+    Listing of one folder on a rig computer, read once with os.scandir. The stat result of every entry is kept, so
+    looking files up by name, modified date or time doesn't go back to the (often remote) share.
+
+    Methods
+    ----------
+    scan()
+    stat(path)
+    matching(pattern)
+    modified_on(date)
+    """
+    def __init__(self, folder):
+        """
+        Parameters
+        ----------
+        folder: path
+            Folder to index. Sub-folders are listed as entries but not scanned.
+        """
+        self.folder = folder
+        self.scan()
+
+    def scan(self):
+        """(Re)reads the folder."""
+        self.entries = {}
+        self.by_date = {}
+        with os.scandir(self.folder) as entries:
+            for entry in entries:
+                stat = entry.stat()
+                self.entries[entry.name] = (entry.path, stat)
+                date = datetime.fromtimestamp(stat.st_mtime).strftime('%Y-%m-%d')
+                self.by_date.setdefault(date, []).append(entry.name)
+
+    def stat(self, path):
+        """Cached stat result of a file in the folder, given by name or full path."""
+        return self.entries[os.path.basename(path)][1]
+
+    def matching(self, pattern):
+        """Sorted full paths of the entries whose names match a glob-style pattern, e.g. '*2021-05-04*'."""
+        return sorted([self.entries[name][0] for name in fnmatch.filter(self.entries.keys(), pattern)])
+
+    def modified_on(self, date):
+        """Sorted full paths of the entries last modified on date (YYYY-MM-DD)."""
+        return sorted([self.entries[name][0] for name in self.by_date.get(date, [])])
+
+
+class TransferManifest():
+    """
+    Record of the files transferred into a session folder, kept in transfer_manifest.json in that folder.
+    Each entry is keyed by the path relative to the folder and holds the source file's size and modified time and the
+    CRC32 of the copied data, so later stages can check the transferred files against it.
+
+    Updates are saved at most every MANIFEST_INTERVAL seconds; call save() once the transfer is done.
+
+    Methods
+    ----------
+    update(rel_path, entry)
+    update_many(entries)
+    save(force=True)
+    is_current(src, rel_path)
+    verify(rel_path, check_crc=False)
+    """
+    def __init__(self, folder):
+        self.folder = folder
+        self.manifest_file = os.path.join(folder, MANIFEST_NAME)
+        self.lock = threading.Lock()
+        self.unsaved = False
+        self.last_save = time.time()
+        self.entries = {}
+        if os.path.exists(self.manifest_file):
+            with open(self.manifest_file, 'r') as f:
+                self.entries = json.load(f)
+
+    @staticmethod
+    def key(rel_path):
+        return os.path.normpath(rel_path).replace('\\', '/')
+
+    def update(self, rel_path, entry):
+        """Records a transferred file. The manifest is saved if it hasn't been for MANIFEST_INTERVAL seconds."""
+        self.update_many({rel_path: entry})
+
+    def update_many(self, entries):
+        """Records several transferred files, given as {rel_path: entry}."""
+        with self.lock:
+            for rel_path, entry in entries.items():
+                self.entries[self.key(rel_path)] = entry
+            self.unsaved = True
+        self.save(force=False)
+
+    def save(self, force=True):
+        """Writes the manifest if it has unsaved updates. If not force, only when the last save was MANIFEST_INTERVAL seconds ago."""
+        with self.lock:
+            if (self.unsaved==False) or ((force==False) and (time.time() - self.last_save < MANIFEST_INTERVAL)):
+                return
+            os.makedirs(self.folder, exist_ok=True)
+            write_json(self.manifest_file, self.entries)
+            self.unsaved = False
+            self.last_save = time.time()
+
+    def is_current(self, src, rel_path):
+        """
+        True if rel_path was transferred from src and src hasn't changed since.
+        A file that isn't in the manifest but is already in the folder with the source's size and modified time
+        (e.g. copied before the manifest existed) counts as current and is added to the manifest without a checksum.
+        """
+        src_stat = os.stat(src)
+        src_entry = {'size': src_stat.st_size, 'mtime': src_stat.st_mtime}
+        entry = self.entries.get(self.key(rel_path))
+        if entry is None:
+            path = os.path.join(self.folder, rel_path)
+            if os.path.exists(path)==False:
+                return False
+            dst_stat = os.stat(path)
+            if entries_match(src_entry, {'size': dst_stat.st_size, 'mtime': dst_stat.st_mtime}):
+                self.update(rel_path, {'size': src_stat.st_size, 'mtime': src_stat.st_mtime, 'crc32': None})
+                return True
+            return False
+        return entries_match(src_entry, entry) and self.verify(rel_path)
+
+    def verify(self, rel_path, check_crc=False):
+        """
+        True if rel_path is in the manifest and the file in the folder has the recorded size
+        (and checksum, if check_crc, which reads the whole file; entries recorded without a checksum only check size).
+        Files stored compressed are checked against their compressed size and the checksum of the data they hold.
+        """
+        entry = self.entries.get(self.key(rel_path))
+        path = os.path.join(self.folder, rel_path)
+        if (entry is None) or (os.path.exists(path)==False):
+            return False
+        if os.path.getsize(path) != entry.get('stored_size', entry['size']):
+            return False
+        if (check_crc==True) and (entry.get('crc32') is not None):
+            if 'stored_size' in entry:
+                return ct.data_crc32(path) == entry['crc32']
+            return file_crc32(path) == entry['crc32']
+        return True
+
+
+class TransferEngine():
+    """
+    Copies files concurrently, with a bounded thread pool for each source computer so no rig computer gets more than
+    threads_per_host simultaneous reads. Files can go to several destination folders at once: each source file is read
+    once and written to every destination that needs it with tee_copy. Each destination has its own TransferManifest;
+    files the manifests show are already transferred from an unchanged source are skipped.
+
+    Methods
+    ----------
+    submit(src, rel_path)
+    transfer(src, rel_path)
+    add_callback(callback)
+    wait()
+    """
+    def __init__(self, destination_folder, threads_per_host=4, buffer_size=COPY_BUFFER_SIZE, manifest=None, verify=False):
+        """
+        Parameters
+        ----------
+        destination_folder: path or list of paths
+            Folder(s) that the relative destination paths passed to submit are joined to, usually the session folder
+        threads_per_host: int, optional
+            Largest number of files copied at once from one source computer. default = 4
+        buffer_size: int, optional
+            Copy buffer in bytes. default = 16 MB
+        manifest: TransferManifest, optional
+            Manifest of the first destination folder. default None opens the folder's manifest
+        verify: bool, optional
+            Re-read each copied file and check its checksum against the source. default = False only checks sizes
+        """
+        if isinstance(destination_folder, (list, tuple))==False:
+            destination_folder = [destination_folder]
+        self.destination_folders = list(destination_folder)
+        self.manifests = [TransferManifest(folder) for folder in self.destination_folders[1:]]
+        if manifest is None:
+            manifest = TransferManifest(self.destination_folders[0])
+        self.manifests.insert(0, manifest)
+        self.manifest = manifest
+        self.destination_folder = self.destination_folders[0]
+        self.threads_per_host = threads_per_host
+        self.buffer_size = buffer_size
+        self.verify = verify
+        self.pools = {}
+        self.jobs = []
+        self.callbacks = []
+
+    def add_callback(self, callback):
+        """
+        Registers callback(src, rel_path, copied), called from the copying thread whenever a file is in place in every
+        destination, whether it was copied (copied=True) or already up to date (copied=False).
+        """
+        self.callbacks.append(callback)
+
+    def run_callbacks(self, src, rel_path, copied):
+        for callback in self.callbacks:
+            try:
+                callback(src, rel_path, copied)
+            except Exception as e:
+                print("---------transfer callback failed for {}: {}---------".format(rel_path, e))
+
+    def submit(self, src, rel_path, compress=False):
+        """
+        Queues src to be copied to rel_path inside the destination folder(s).
+        """
+        host = source_host(src)
+        if host not in self.pools:
+            self.pools[host] = ThreadPoolExecutor(max_workers=self.threads_per_host)
+        dst = os.path.join(self.destination_folder, rel_path)
+        future = self.pools[host].submit(self.transfer, src, rel_path, compress)
+        self.jobs.append((src, dst, future))
+
+    def transfer(self, src, rel_path, compress=False):
+        """
+        Copies src to rel_path in every destination whose manifest doesn't show it's already there, reading src once,
+        and records it in those manifests. Returns True if the file was copied anywhere, False if it was skipped.
+        If compress, src is a continuous.dat that is stored as a compressed continuous.cdat at rel_path instead (see compress_tools).
+        """
+        needed = [(folder, manifest) for folder, manifest in zip(self.destination_folders, self.manifests) if manifest.is_current(src, rel_path)==False]
+        if len(needed) == 0:
+            self.run_callbacks(src, rel_path, False)
+            return False
+        dsts = [os.path.join(folder, rel_path) for folder, manifest in needed]
+        if compress==True:
+            src_stat = os.stat(src)
+            info = ct.compress_dat(src, dsts)
+            entry = {'size': src_stat.st_size, 'mtime': src_stat.st_mtime, 'crc32': info['crc32'], 'stored_size': info['stored_size']}
+            if (self.verify==True) and any([ct.data_crc32(dst) != info['crc32'] for dst in dsts]):
+                raise IOError("compressed copy of {} doesn't match its checksum".format(src))
+        else:
+            entry = tee_copy(src, dsts, self.buffer_size, self.verify)
+        for folder, manifest in needed:
+            manifest.update(rel_path, entry)
+        self.run_callbacks(src, rel_path, True)
+        return True
+
+    def wait(self):
+        """
+        Waits for every queued copy to finish and shuts the thread pools down.
+        Returns a list of (src, dst, error) for the copies that failed.
+        """
+        start = time.time()
+        failed = []
+        n_skipped = 0
+        for src, dst, future in self.jobs:
+            try:
+                if future.result()==False:
+                    n_skipped += 1
+            except Exception as e:
+                print("---------failed to transfer {}: {}---------".format(src, e))
+                failed.append((src, dst, e))
+        for pool in self.pools.values():
+            pool.shutdown()
+        for manifest in self.manifests:
+            manifest.save()
+        print("{} files transferred, {} already up to date, {} failed. Waited {} seconds".format(len(self.jobs)-len(failed)-n_skipped, n_skipped, len(failed), time.time()-start))
+        self.jobs = []
+        self.pools = {}
+        return failed
@@ -0,0 +1,162 @@
+import os
+import json
+import time
+
+import numpy as np
+
+import np2_ultra.tools.compress_tools as ct
+
+REPORT_NAME = 'continuous_validation.json'
+INT16_RAILS = (-32768, 32767)
+
+
+def sample_blocks(data, n_blocks=32, block_samples=1500):
+    """
+    Reads n_blocks blocks of block_samples samples spread evenly over a (samples, channels) array,
+    always including the first and last block. Returns a (n_blocks, block_samples, channels) array.
+    """
+    n_samples = data.shape[0]
+    block_samples = min(block_samples, n_samples)
+    n_blocks = max(1, min(n_blocks, n_samples // max(block_samples, 1)))
+    starts = np.linspace(0, n_samples - block_samples, n_blocks).astype(np.int64)
+    return np.stack([np.asarray(data[start:start+block_samples]) for start in starts]), starts
+
+def channel_stats(blocks, rails=INT16_RAILS):
+    """
+    Per channel RMS (around the channel median), standard deviation and fraction of samples at or beyond the
+    rails (lowest, highest) value, ie clipped, from the sampled blocks.
+    """
+    samples = blocks.reshape(-1, blocks.shape[-1]).astype(np.float32)
+    centered = samples - np.median(samples, axis=0)
+    rms = np.sqrt(np.mean(centered**2, axis=0))
+    std = samples.std(axis=0)
+    clipped = ((samples <= rails[0]) | (samples >= rails[1])).mean(axis=0)
+    return rms, std, clipped
+
+def validate_dat(data_dir, n_channels=384, n_blocks=32, block_samples=1500, flat_std=1.0, noisy_factor=5.0,
+                 max_clipped=0.01, rails=INT16_RAILS, max_bad_channels=0.25, max_zero_blocks=0.1, save=True):
+    """
+    Quick check of a probe's continuous.dat (or continuous.cdat) before it's sorted, from a few evenly spaced blocks
+    of samples rather than the whole file. Checks that:
+        the file holds a whole number of samples of n_channels int16 channels
+        it has as many samples as the probe's timestamps.npy (a shorter file was cut off)
+        the sampled blocks aren't all zeros (zero filled end of a failed copy)
+        no more than max_bad_channels of the channels are flat, clipped or noisy
+    The report is saved as continuous_validation.json in data_dir, with the size and modified time of the data and
+    timestamps.npy so it's reused until either changes. If timestamps.npy isn't there (yet) the length can't be checked,
+    which is reported as a problem and report['final'] is False: the report isn't saved, and the problem shouldn't be
+    used to flag the probe for good since it goes away once timestamps.npy is in place.
+
+    Parameters
+    ----------
+    data_dir: path
+        Probe data folder, eg recording1/continuous/Neuropix-PXI-100.0
+    n_channels: int, optional
+        default = 384
+    n_blocks: int, optional
+        Number of blocks sampled. default = 32
+    block_samples: int, optional
+        Samples per block. default = 1500 (50ms at 30kHz)
+    flat_std: float, optional
+        Channels with a standard deviation under this (in bits) are flat. default = 1.0
+    noisy_factor: float, optional
+        Channels with an RMS over this many times the median channel RMS are noisy. default = 5.0
+    max_clipped: float, optional
+        Channels with more than this fraction of samples at or beyond the rails are clipped. default = 0.01
+    rails: (int, int), optional
+        Lowest and highest value the data can take. default = int16 limits, pass the ADC's range (in the file's units)
+        if it's narrower
+    max_bad_channels: float, optional
+        Fraction of flat, clipped or noisy channels above which the probe fails. default = 0.25
+    max_zero_blocks: float, optional
+        Fraction of all zero blocks above which the probe fails. default = 0.1
+    save: bool, optional
+        Save the report in data_dir. default = True
+
+    Returns
+    ----------
+    report: dict, report['passed'] is False if kilosort shouldn't be run and report['problems'] lists why.
+        report['warnings'] lists problems that don't stop kilosort. report['final'] is False if the result may
+        change without the data changing (timestamps.npy is missing)
+    """
+    start = time.time()
+    report_file = os.path.join(data_dir, REPORT_NAME)
+    dat_file = os.path.join(data_dir, 'continuous.dat')
+    if (os.path.exists(dat_file)==False) and os.path.exists(ct.compressed_path(dat_file)):
+        dat_file = ct.compressed_path(dat_file)
+    report = {'file': dat_file, 'passed': False, 'final': True, 'problems': [], 'warnings': []}
+    if os.path.exists(dat_file)==False:
+        report['problems'].append('no continuous.dat')
+        report['final'] = False
+        return report
+
+    dat_stat = os.stat(dat_file)
+    timestamps_file = os.path.join(data_dir, 'timestamps.npy')
+    timestamps_stat = os.stat(timestamps_file) if os.path.exists(timestamps_file) else None
+    fingerprint = [dat_stat.st_size, dat_stat.st_mtime]
+    if timestamps_stat is not None:
+        fingerprint += [timestamps_stat.st_size, timestamps_stat.st_mtime]
+    if os.path.exists(report_file):
+        with open(report_file, 'r') as f:
+            saved = json.load(f)
+        # reports saved before the timestamps were part of the fingerprint aren't marked final, they're made again
+        if (saved.get('file') == dat_file) and (saved.get('fingerprint') == fingerprint) and (saved.get('final')==True):
+            return saved
+    report['fingerprint'] = fingerprint
+
+    if dat_file.endswith(ct.COMPRESSED_NAME):
+        data = ct.CompressedDat(dat_file)
+        extra_bytes = len(bytes.fromhex(data.header['tail']))
+    else:
+        # only the whole samples, a cut off file can't be reshaped as a whole
+        extra_bytes = dat_stat.st_size % (2*n_channels)
+        n_whole = dat_stat.st_size // (2*n_channels)
+        data = np.memmap(dat_file, dtype='int16', mode='r', shape=(n_whole, n_channels)) if n_whole > 0 else np.zeros((0, n_channels), dtype='int16')
+    n_samples = data.shape[0]
+    report['n_samples'] = int(n_samples)
+    if extra_bytes != 0:
+        report['problems'].append('file ends {} bytes into a sample, it was cut off'.format(extra_bytes))
+
+    if timestamps_stat is None:
+        report['problems'].append("no timestamps.npy to check the file's length against")
+        report['final'] = False
+    else:
+        try:
+            n_timestamps = np.load(timestamps_file, mmap_mode='r').shape[0]
+        except Exception as e:
+            # doesn't stop kilosort, but the recording can't be aligned until it's replaced
+            report['warnings'].append("couldn't read timestamps.npy: {}".format(e))
+            n_timestamps = None
+        report['n_timestamps'] = n_timestamps
+        if (n_timestamps is not None) and (n_samples < n_timestamps):
+            report['problems'].append('{} samples but {} timestamps, the file was cut off'.format(n_samples, n_timestamps))
+
+    if n_samples == 0:
+        report['problems'].append('no samples')
+    else:
+        blocks, starts = sample_blocks(data, n_blocks, block_samples)
+        zero_blocks = starts[(blocks == 0).all(axis=(1, 2))]
+        rms, std, clipped = channel_stats(blocks, rails)
+        median_rms = float(np.median(rms))
+        flat = np.where(std < flat_std)[0]
+        clipped = np.where(clipped > max_clipped)[0]
+        noisy = np.where(rms > noisy_factor*median_rms)[0] if median_rms > 0 else np.array([], dtype=int)
+        bad = np.unique(np.concatenate([flat, clipped, noisy]))
+        report.update({'n_blocks': len(starts),
+                        'zero_block_starts': zero_blocks.tolist(),
+                        'median_rms': median_rms,
+                        'channel_rms': np.round(rms, 2).tolist(),
+                        'flat_channels': flat.tolist(),
+                        'clipped_channels': clipped.tolist(),
+                        'noisy_channels': noisy.tolist()})
+        if len(zero_blocks) > max_zero_blocks*len(starts):
+            report['problems'].append('{} of {} sampled blocks are all zeros'.format(len(zero_blocks), len(starts)))
+        if len(bad) > max_bad_channels*n_channels:
+            report['problems'].append('{} bad channels ({} flat, {} clipped, {} noisy)'.format(len(bad), len(flat), len(clipped), len(noisy)))
+
+    report['passed'] = len(report['problems']) == 0
+    report['seconds'] = time.time() - start
+    if (save==True) and (report['final']==True):
+        with open(report_file, 'w') as f:
+            json.dump(report, f, indent=1)
+    return report
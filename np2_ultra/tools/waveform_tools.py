@@ -0,0 +1,346 @@
+import numpy as np
+
+import np2_ultra.tools.analysis_tools as ant
+import np2_ultra.tools.compress_tools as ct
+
+
+def bootstrap_index_matrix(n_spikes, n_boots, n, rng=None):
+    """
+    Draws the resampling indices for every bootstrap at once.
+    Row i holds the indices ant.bootstrap_resample would draw on its i-th call, so a fixed seed gives the same resamples as the per-bootstrap loop.
+
+    Parameters
+    ----------
+    n_spikes: int
+        Number of spikes to resample from
+    n_boots: int
+        Number of bootstraps
+    n: int
+        Number of spikes drawn per bootstrap
+    rng: np.random.RandomState, optional
+        default None uses the global numpy random state
+
+    Returns
+    ----------
+    boot_idx: (n_boots, n) int array of spike indices
+    """
+    if rng is None:
+        rng = np.random
+    boot_idx = np.floor(rng.rand(n_boots, n)*n_spikes).astype(int)
+    return boot_idx
+
+def read_windows(data, starts, n_samples, max_gap=3000, max_chunk=65536, channels=None):
+    """
+    Reads fixed length windows of data in sample order, coalescing nearby windows into single sequential chunk reads.
+    Each unique window is read once. Windows are returned in the order they were requested.
+
+    Parameters
+    ----------
+    data: (samples, channels) array or memmap
+    starts: 1D int array of window start samples. All windows must lie inside data.
+    n_samples: int
+        Window length in samples
+    max_gap: int, optional
+        Largest gap in samples between two windows that still gets read as one chunk. default = 3000 (0.1s at 30kHz)
+    max_chunk: int, optional
+        Largest chunk in samples read at once. default = 65536
+    channels: int array, optional
+        Data channels to keep. default None keeps all channels
+
+    Returns
+    ----------
+    windows: (len(starts), n_samples, channels) array in the dtype of data
+    """
+    unique_starts, order = np.unique(np.asarray(starts, dtype=np.int64), return_inverse=True)
+    n_channels = data.shape[1] if channels is None else len(channels)
+    windows = np.empty((unique_starts.size, n_samples, n_channels), dtype=data.dtype)
+    if unique_starts.size == 0:
+        return windows[order]
+
+    group_starts = [0]
+    for i in range(1, unique_starts.size):
+        gap = unique_starts[i] - unique_starts[i-1] - n_samples
+        span = unique_starts[i] + n_samples - unique_starts[group_starts[-1]]
+        if (gap > max_gap) or (span > max_chunk):
+            group_starts.append(i)
+    group_starts.append(unique_starts.size)
+
+    offsets = np.arange(n_samples)
+    for g in range(len(group_starts)-1):
+        in_group = slice(group_starts[g], group_starts[g+1])
+        chunk_start = unique_starts[group_starts[g]]
+        chunk_end = unique_starts[group_starts[g+1]-1] + n_samples
+        chunk = np.asarray(data[chunk_start:chunk_end])
+        if channels is not None:
+            chunk = chunk[:, channels]
+        windows[in_group] = chunk[(unique_starts[in_group] - chunk_start)[:, None] + offsets]
+
+    return windows[order]
+
+def gather_snippets(data, peak_times, samples_per_spike, pre_samples, max_gap=3000, max_chunk=65536, channels=None):
+    """
+    Reads the waveform snippet around each peak time and subtracts each snippet's first sample.
+    Snippets are read in sample order through read_windows.
+
+    Parameters
+    ----------
+    data: (samples, channels) array or memmap
+    peak_times: 1D int array of spike peak sample indices
+    samples_per_spike: int
+    pre_samples: int
+    max_gap, max_chunk, channels: optional
+        passed to read_windows
+
+    Returns
+    ----------
+    snippets: (spikes, samples_per_spike, channels) array in the dtype of data. Snippets that run off either end of data are zeros.
+    valid: bool array, False where the snippet ran off either end of data
+    """
+    starts = np.asarray(peak_times, dtype=np.int64).ravel() - pre_samples
+    valid = (starts >= 0) & (starts + samples_per_spike <= data.shape[0])
+    n_channels = data.shape[1] if channels is None else len(channels)
+    snippets = np.zeros((starts.size, samples_per_spike, n_channels), dtype=data.dtype)
+    if valid.any():
+        snippets[valid] = read_windows(data, starts[valid], samples_per_spike, max_gap=max_gap, max_chunk=max_chunk, channels=channels)
+    # baseline subtraction is done in the raw dtype to match the per-spike loop exactly
+    snippets -= snippets[:, :1, :]
+    return snippets, valid
+
+def bootstrap_waveform_stats(snippets, valid, boot_idx, batch_size=10):
+    """
+    Computes the bootstrapped mean waveform and SNR from baseline subtracted snippets.
+
+    Parameters
+    ----------
+    snippets: (spikes, samples, channels) array from gather_snippets
+    valid: bool array from gather_snippets
+    boot_idx: (n_boots, n) int array indexing into snippets
+    batch_size: int, optional
+        Number of bootstraps computed together. Memory use scales with batch_size * samples * channels * n. default = 10
+
+    Returns
+    ----------
+    mean_waveform: (samples, channels) array, mean across bootstraps of the bootstrap means
+    mean_SNR: (samples, channels) array, mean across bootstraps of the bootstrap SNRs
+    """
+    n_boots = boot_idx.shape[0]
+    waveform_boots = np.zeros((n_boots,) + snippets.shape[1:])
+    SNR_boots = np.zeros(waveform_boots.shape)
+    full_boot = valid[boot_idx].all(axis=1)
+
+    for batch_start in range(0, n_boots, batch_size):
+        rows = np.arange(batch_start, min(batch_start+batch_size, n_boots))
+        full_rows = rows[full_boot[rows]]
+        if full_rows.size > 0:
+            # (boots, samples, channels, spikes) so the reductions run over the same contiguous axis as the loop version
+            waveforms = np.ascontiguousarray(np.moveaxis(snippets[boot_idx[full_rows]], 1, -1), dtype=np.float64)
+            SNR_boots[full_rows] = ant.signaltonoise(waveforms, axis=-1)
+            waveform_boots[full_rows] = np.mean(waveforms, -1)
+        for i in rows[~full_boot[rows]]:
+            waveforms = np.ascontiguousarray(np.moveaxis(snippets[boot_idx[i]], 0, -1), dtype=np.float64)
+            # drop the bad spikes the same way the loop version does so the reductions see the same memory layout
+            waveforms = waveforms[:, :, np.flatnonzero(valid[boot_idx[i]])]
+            SNR_boots[i] = ant.signaltonoise(waveforms, axis=-1)
+            waveform_boots[i] = np.mean(waveforms, -1)
+
+    return np.mean(waveform_boots, 0), np.mean(SNR_boots, 0)
+
+def streaming_waveform_stats(data, peak_times, boot_idx, samples_per_spike, pre_samples, chunk_spikes=256,
+                            dtype=np.float64, max_gap=3000, max_chunk=65536, channels=None):
+    """
+    Computes the bootstrapped mean waveform and SNR with running (Welford/Chan) mean and variance accumulators.
+    Snippets are read chunk_spikes at a time and folded into every bootstrap that drew them, so memory use doesn't
+    depend on the number of spikes per bootstrap.
+
+    Parameters
+    ----------
+    data: (samples, channels) array or memmap
+    peak_times: 1D int array of the cluster's spike peak sample indices
+    boot_idx: (n_boots, n) int array indexing into peak_times
+    samples_per_spike: int
+    pre_samples: int
+    chunk_spikes: int, optional
+        Number of unique spikes read and folded in at once. default = 256
+    dtype: numpy dtype, optional
+        Working precision of the accumulators. default = np.float64
+    max_gap, max_chunk, channels: optional
+        passed to read_windows
+
+    Returns
+    ----------
+    mean_waveform: (samples, channels) float64 array, mean across bootstraps of the bootstrap means
+    mean_SNR: (samples, channels) float64 array, mean across bootstraps of the bootstrap SNRs
+    """
+    n_boots = boot_idx.shape[0]
+    unique_idx, inverse = np.unique(boot_idx, return_inverse=True)
+    # counts[b, i]: how many times bootstrap b drew unique spike i
+    boot_rows = np.repeat(np.arange(n_boots), boot_idx.shape[1])
+    counts = np.bincount(boot_rows*unique_idx.size + inverse.ravel(),
+                        minlength=n_boots*unique_idx.size).reshape(n_boots, unique_idx.size)
+    times = np.asarray(peak_times)[unique_idx]
+
+    n_channels = data.shape[1] if channels is None else len(channels)
+    n = np.zeros((n_boots, 1), dtype=dtype)
+    mean = np.zeros((n_boots, samples_per_spike*n_channels), dtype=dtype)
+    M2 = np.zeros(mean.shape, dtype=dtype)
+
+    for chunk_start in range(0, unique_idx.size, chunk_spikes):
+        in_chunk = slice(chunk_start, chunk_start+chunk_spikes)
+        snippets, valid = gather_snippets(data, times[in_chunk], samples_per_spike, pre_samples,
+                                        max_gap=max_gap, max_chunk=max_chunk, channels=channels)
+        if valid.any() == False:
+            continue
+        x = snippets[valid].reshape(valid.sum(), -1).astype(dtype)
+        w = counts[:, in_chunk][:, valid].astype(dtype)
+        n_chunk = w.sum(axis=1, keepdims=True)
+        in_boot = n_chunk[:, 0] > 0
+
+        # weighted mean and M2 of the chunk for each bootstrap, shifted by the chunk mean to limit cancellation
+        shift = x.mean(axis=0)
+        x = x - shift
+        mean_chunk = (w @ x)[in_boot] / n_chunk[in_boot]
+        M2_chunk = np.maximum((w @ (x*x))[in_boot] - n_chunk[in_boot]*mean_chunk**2, 0)
+        mean_chunk += shift
+
+        # merge the chunk into the running accumulators
+        n_old = n[in_boot]
+        n_new = n_old + n_chunk[in_boot]
+        delta = mean_chunk - mean[in_boot]
+        mean[in_boot] += delta*n_chunk[in_boot]/n_new
+        M2[in_boot] += M2_chunk + delta**2*n_old*n_chunk[in_boot]/n_new
+        n[in_boot] = n_new
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        sd = np.sqrt(M2/n)
+        SNR = np.where(sd == 0, 0, mean/sd)
+    mean[n[:, 0] == 0] = np.nan
+    mean_waveform = np.mean(mean.astype(np.float64), 0).reshape(samples_per_spike, n_channels)
+    mean_SNR = np.mean(SNR.astype(np.float64), 0).reshape(samples_per_spike, n_channels)
+    return mean_waveform, mean_SNR
+
+def cluster_seed(seed, cluster_num):
+    """
+    Derives the random seed for one cluster from the session seed, so the bootstraps of a cluster don't depend on which
+    worker runs it or on the order clusters are run in.
+    """
+    return int(np.random.SeedSequence([seed, cluster_num]).generate_state(1)[0])
+
+def bootstrap_cluster(data, times_for_cluster, extraction_params, rng=None, channels=None):
+    """
+    Bootstraps the mean waveform and SNR of one cluster from a single read of every spike the bootstraps need.
+    In 'streaming' extraction mode the statistics are accumulated chunk by chunk with streaming_waveform_stats instead.
+
+    Parameters
+    ----------
+    data: (samples, channels) array or memmap
+    times_for_cluster: array of the cluster's spike times in samples, (spikes,) or (spikes, 1)
+    extraction_params: dict
+        GetWaveforms.extraction_params
+    rng: np.random.RandomState, optional
+        default None uses the global numpy random state
+    channels: int array, optional
+        Data channels to bootstrap. default None uses all channels
+
+    Returns
+    ----------
+    mean_waveform, mean_SNR: (samples, channels) arrays
+    """
+    boot_idx = bootstrap_index_matrix(len(times_for_cluster),
+                                    extraction_params['n_boots'],
+                                    extraction_params['tot_waveforms'],
+                                    rng=rng)
+    peak_times = np.reshape(times_for_cluster, (len(times_for_cluster), -1))[:, 0]
+    if extraction_params['extraction_mode'] == 'streaming':
+        return streaming_waveform_stats(data, peak_times, boot_idx,
+                                        extraction_params['samples_per_spike'],
+                                        extraction_params['pre_samples'],
+                                        chunk_spikes=extraction_params['stream_chunk_spikes'],
+                                        dtype=np.dtype(extraction_params['working_dtype']),
+                                        max_gap=extraction_params['read_gap_samples'],
+                                        max_chunk=extraction_params['read_chunk_samples'],
+                                        channels=channels)
+
+    unique_idx, boot_idx = np.unique(boot_idx, return_inverse=True)
+    boot_idx = boot_idx.reshape(extraction_params['n_boots'], extraction_params['tot_waveforms'])
+    snippets, valid = gather_snippets(data,
+                                    peak_times[unique_idx],
+                                    extraction_params['samples_per_spike'],
+                                    extraction_params['pre_samples'],
+                                    max_gap=extraction_params['read_gap_samples'],
+                                    max_chunk=extraction_params['read_chunk_samples'],
+                                    channels=channels)
+    return bootstrap_waveform_stats(snippets, valid, boot_idx, batch_size=extraction_params['boot_batch_size'])
+
+def cluster_channel_rows(data, times_for_cluster, extraction_params, channel_map, channel_positions):
+    """
+    Finds a cluster's peak channel from a cheap mean of up to extraction_params['peak_spikes'] evenly spaced spikes
+    and returns the channels within extraction_params['channel_radius'] microns of it.
+
+    Parameters
+    ----------
+    data: (samples, channels) array or memmap
+    times_for_cluster: array of the cluster's spike times in samples
+    extraction_params: dict
+        GetWaveforms.extraction_params
+    channel_map: int array
+        kilosort channel_map, data channel of each row of channel_positions
+    channel_positions: (channels, 2) array
+        kilosort channel_positions in microns
+
+    Returns
+    ----------
+    channel_rows: int array of rows of channel_map/channel_positions in the neighborhood, in channel_map order.
+        Every row if the cluster has no spikes that could be read whole
+    """
+    if len(times_for_cluster) == 0:
+        print("no spikes to find the peak channel from, using all channels")
+        return np.arange(len(channel_map))
+    times = np.reshape(times_for_cluster, (len(times_for_cluster), -1))[:, 0]
+    sample_idx = np.unique(np.linspace(0, len(times)-1, min(len(times), extraction_params['peak_spikes'])).astype(int))
+    snippets, valid = gather_snippets(data,
+                                    times[sample_idx],
+                                    extraction_params['samples_per_spike'],
+                                    extraction_params['pre_samples'],
+                                    max_gap=extraction_params['read_gap_samples'],
+                                    max_chunk=extraction_params['read_chunk_samples'],
+                                    channels=channel_map)
+    if np.any(valid)==False:
+        # no spike far enough from the ends of the recording to average, there's no peak channel to center on
+        print("no whole spikes to find the peak channel from, using all channels")
+        return np.arange(len(channel_map))
+    mean_waveform = np.mean(snippets[valid], axis=0, dtype=np.float64)
+    peak_row = np.argmax(np.ptp(mean_waveform, axis=0))
+    distance = np.linalg.norm(channel_positions - channel_positions[peak_row], axis=1)
+    channel_rows = np.flatnonzero(distance <= extraction_params['channel_radius'])
+    return channel_rows
+
+def extract_cluster_waveforms(raw_data_file, times_for_cluster, extraction_params, seed, channel_map=None, channel_positions=None):
+    """
+    Process pool worker for GetWaveforms.get_waveforms. Opens its own read-only memmap of the continuous.dat file
+    (or its own reader of continuous.cdat) and bootstraps one cluster with its own random state.
+
+    Parameters
+    ----------
+    raw_data_file: path to continuous.dat or continuous.cdat
+    times_for_cluster: array of the cluster's spike times in samples
+    extraction_params: dict
+        GetWaveforms.extraction_params
+    seed: int
+        The cluster's seed from cluster_seed
+    channel_map, channel_positions: arrays, optional
+        Needed when extraction_params['channel_radius'] is set, see cluster_channel_rows
+
+    Returns
+    ----------
+    mean_waveform, mean_SNR: (samples, channels) arrays
+    channel_rows: rows of channel_map the columns of mean_waveform belong to, or None if all channels were used
+    """
+    data = ct.open_continuous(raw_data_file, extraction_params['n_channels'])
+    channel_rows = None
+    channels = None
+    if extraction_params['channel_radius'] is not None:
+        channel_rows = cluster_channel_rows(data, times_for_cluster, extraction_params, channel_map, channel_positions)
+        channels = channel_map[channel_rows]
+    mean_waveform, mean_SNR = bootstrap_cluster(data, times_for_cluster, extraction_params,
+                                                rng=np.random.RandomState(seed), channels=channels)
+    return mean_waveform, mean_SNR, channel_rows